@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# Backfill Timewarrior with the time tracked in Taskwarrior before the hook
+# was installed.
+#
+#     python3 backfill.py [--dry-run] [--processes N] [~/.task/undo.data]
+#
+# Taskwarrior's undo.data holds every modification as a transaction of the
+# task before ('old') and after ('new') it. These pairs are classified like
+# the hook does, and the intervals the hook would have recorded are written
+# to the Timewarrior data files, with the original timestamps. Only intervals
+# which ended before the first one in the Timewarrior database are written.
+#
+# The file is memory-mapped and split into byte ranges at transaction
+# boundaries, which are parsed by a pool of processes. Their results are
+# consumed in order and only a few ranges are in flight at a time, so memory
+# use does not grow with the size of the history.
+
+import argparse
+import collections
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import on_modify
+
+# Size of the byte ranges parsed by one process.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+SEPARATOR = b'\n---\n'
+
+# An attribute of a task in Taskwarrior's FF4 format: name:"value"
+FF4_ATTRIBUTE = re.compile(r'([^\s:\[\]"]+):"((?:[^"\\]|\\.)*)"')
+
+# Attributes which hold a time, in seconds since the epoch in FF4.
+DATE_FIELDS = ('start', 'end', 'modified', 'entry')
+
+
+def timestamp_from(value):
+    if value.isdigit():
+        return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(int(value)))
+
+    return value
+
+
+def decode_value(value):
+    value = value.replace('&open;', '[').replace('&close;', ']').replace('&dquot;', '\\"')
+
+    try:
+        return json.loads('"' + value + '"')
+    except ValueError:
+        return value
+
+
+def parse_ff4(text):
+    """Parse a task in the FF4 format of undo.data into the form of the hook's input."""
+    task = {}
+    annotations = []
+
+    for name, value in FF4_ATTRIBUTE.findall(text):
+        value = decode_value(value)
+
+        if name.startswith('annotation_'):
+            annotations.append({'entry': timestamp_from(name[11:]), 'description': value})
+        elif name in DATE_FIELDS:
+            task[name] = timestamp_from(value)
+        elif name == 'tags':
+            task[name] = [tag for tag in value.split(',') if tag]
+        else:
+            task[name] = value
+
+    if annotations:
+        task['annotations'] = sorted(annotations, key=lambda annotation: annotation['entry'])
+
+    return task
+
+
+def parse_task_line(text):
+    # Later versions of Taskwarrior write JSON instead of FF4.
+    return on_modify.parse_task(text) if text.startswith('{') else parse_ff4(text)
+
+
+def byte_ranges(data, chunk_size):
+    """Split data into ranges of about chunk_size bytes, ending with transactions."""
+    start = 0
+
+    while start < len(data):
+        end = data.find(SEPARATOR, start + chunk_size)
+        end = len(data) if end == -1 else end + len(SEPARATOR)
+        yield start, end
+        start = end
+
+
+def events_in_range(path, start, end):
+    """Return what the transactions in a byte range of undo.data mean for Timewarrior.
+
+    Each event is a tuple of its kind ('start', 'stop' or 'modify'), the
+    task's UUID, the time, and the tags and annotation of the interval.
+    """
+    events = []
+
+    with open(path, 'rb') as undo_file, mmap.mmap(undo_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        old = new = None
+        position = start
+
+        while position < end:
+            line_end = data.find(b'\n', position, end)
+            line_end = end if line_end == -1 else line_end
+            line = data[position:line_end].decode('utf-8', errors='replace')
+            position = line_end + 1
+
+            if line.startswith('old '):
+                old = parse_task_line(line[4:].strip())
+            elif line.startswith('new '):
+                new = parse_task_line(line[4:].strip())
+            elif line.strip() == '---':
+                if new is not None:
+                    event = event_for(old or {}, new)
+
+                    if event is not None:
+                        events.append(event)
+
+                old = new = None
+
+        if new is not None:
+            event = event_for(old or {}, new)
+
+            if event is not None:
+                events.append(event)
+
+    return events
+
+
+def event_for(old, new):
+    if not on_modify.tracked(old if 'start' in old else new):
+        return None
+
+    transition = on_modify.classify(old, new)
+
+    if transition == on_modify.Transition.START:
+        kind, timestamp, task = 'start', new['start'], new
+    elif transition == on_modify.Transition.STOP:
+        kind, timestamp, task = 'stop', on_modify.transition_time('stop', new), old
+    elif transition:
+        kind, timestamp, task = 'modify', None, new
+    else:
+        return None
+
+    annotation = on_modify.normalize_annotation(on_modify.extract_annotation_from(task))
+
+    return kind, new.get('uuid'), timestamp, on_modify.extract_tags_from(task), annotation
+
+
+def events(path, processes=None, chunk_size=CHUNK_SIZE):
+    """Yield the events of all transactions in undo.data, in order."""
+    with open(path, 'rb') as undo_file:
+        if os.fstat(undo_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(undo_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ranges = list(byte_ranges(data, chunk_size))
+
+    with multiprocessing.Pool(processes) as pool:
+        pending = collections.deque()
+        in_flight = 2 * (processes or os.cpu_count() or 1)
+
+        for start, end in ranges:
+            pending.append(pool.apply_async(events_in_range, (path, start, end)))
+
+            while len(pending) >= in_flight:
+                for event in pending.popleft().get():
+                    yield event
+
+        while pending:
+            for event in pending.popleft().get():
+                yield event
+
+
+def intervals(events):
+    """Yield the closed intervals the hook would have recorded for the events.
+
+    As in Timewarrior, only one interval is open at a time: a start closes
+    the interval of whichever task was running.
+    """
+    current = None
+
+    for kind, uuid, timestamp, tags, annotation in events:
+        if kind == 'start':
+            if current is not None and current[1] < timestamp:
+                yield on_modify.Interval(current[1], timestamp, current[2], current[3])
+
+            current = [uuid, timestamp, tags, annotation]
+
+        elif current is not None and current[0] == uuid:
+            if kind == 'modify':
+                current[2:] = [tags, annotation]
+                continue
+
+            if current[1] < timestamp:
+                yield on_modify.Interval(current[1], timestamp, tags, annotation)
+
+            current = None
+
+
+def first_recorded(data_dir):
+    # Start of the earliest interval in the Timewarrior database, if any.
+    try:
+        names = on_modify.month_files(data_dir)
+    except OSError:
+        return None
+
+    for name in names:
+        lines = on_modify.DataFileBackend._read(os.path.join(data_dir, name))
+
+        if lines:
+            return on_modify.Interval.parse(min(lines)).start
+
+    return None
+
+
+def backfill(path, db_dir, processes=None, chunk_size=CHUNK_SIZE, output=None):
+    """Write the intervals found in undo.data to the Timewarrior database.
+
+    Intervals are written a month at a time. If output is given, they are
+    written to it as data file lines instead. Returns their number.
+    """
+    backend = on_modify.DataFileBackend(db_dir)
+    cutoff = first_recorded(backend.data_dir)
+    month, batch, count = None, [], 0
+
+    for interval in intervals(events(path, processes, chunk_size)):
+        if cutoff is not None and interval.end > cutoff:
+            continue
+
+        if interval.start[:6] != month and batch:
+            backend.add(batch)
+            batch = []
+
+        month = interval.start[:6]
+        count += 1
+
+        if output is not None:
+            output.write(interval.serialize() + '\n')
+        else:
+            batch.append(interval)
+
+    if batch:
+        backend.add(batch)
+
+    return count
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Backfill Timewarrior from Taskwarrior\'s undo.data.')
+    parser.add_argument('undo_file', nargs='?', default=os.path.expanduser('~/.task/undo.data'))
+    parser.add_argument('--processes', type=int, default=None, help='number of parsing processes')
+    parser.add_argument('--dry-run', action='store_true', help='print the intervals instead of writing them')
+    args = parser.parse_args(argv)
+
+    count = backfill(args.undo_file, on_modify.timew_db_dir(), args.processes,
+                     output=sys.stdout if args.dry_run else None)
+    sys.stderr.write('{} intervals {}.\n'.format(count, 'found' if args.dry_run else 'written'))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# On-exit companion of the on-modify hook.
+#
+# Taskwarrior runs on-exit hooks once per command, with every task the command
+# added or modified on stdin. Installed as `on-exit.timewarrior` instead of
+# the on-modify hook, this follows all of them in Timewarrior in one process.
+#
+# On-exit hooks only get the tasks as they are now. What the on-modify hook
+# would have seen before a modification is rebuilt from `running.json` in the
+# state directory, which keeps the fields the hook needs of every running task.
+# Tasks already running when the hook is installed are made known with
+#
+#     task +ACTIVE export | ~/.task/hooks/on-exit.timewarrior seed
+
+import json
+import sys
+
+import on_modify
+
+
+def minimal(task):
+    # The fields of a task the hook and its rules look at.
+    return dict((key, task[key]) for key in on_modify.task_fields() if key in task)
+
+
+def transitions(tasks, running):
+    """Pair the tasks modified by a command with their previous versions.
+
+    Tasks which neither were nor are running are left out. Updates running,
+    the minimal versions of the running tasks by UUID, to the new versions.
+    """
+    pairs = []
+
+    for new in tasks:
+        uuid = new.get('uuid')
+        old = running.pop(uuid, None)
+
+        if on_modify.is_running(new):
+            running[uuid] = minimal(new)
+
+        if old is None:
+            # A completed or deleted task keeps its start; only a running one
+            # can have been started by this command.
+            if not on_modify.is_running(new):
+                continue
+
+            # Started by this command.
+            old = dict((key, value) for key, value in minimal(new).items() if key not in ('start', 'end'))
+
+        pairs.append((old, new))
+
+    return pairs
+
+
+def commands_for(tasks):
+    """Return the combined timew commands for the tasks modified by a command."""
+    running = on_modify.load_state('running.json', {})
+    previous = dict(running)
+    commands = []
+
+    for old, new in transitions(tasks, running):
+        commands.extend(on_modify.commands_for(old, new))
+
+    if running != previous:
+        on_modify.save_state('running.json', running)
+
+    return on_modify.coalesce(commands, float(on_modify.setting('debounce') or 0))
+
+
+def read_tasks():
+    text = on_modify.input_stream.read().decode('utf-8', errors='replace').strip()
+
+    # 'task export' prints a JSON array, hooks get one task per line.
+    if text.startswith('['):
+        return json.loads(text)
+
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def seed(tasks):
+    """Record which tasks are running, from the output of 'task export'."""
+    on_modify.save_state('running.json', dict((task['uuid'], minimal(task)) for task in tasks
+                                              if 'start' in task and 'end' not in task))
+
+
+def run():
+    tasks = read_tasks()
+
+    if sys.argv[1:] == ['seed']:
+        seed(tasks)
+        return
+
+    # Reports like 'task list' run on-exit hooks too, without any tasks.
+    if not tasks:
+        return
+
+    with on_modify.hook_lock():
+        commands = commands_for(tasks)
+
+        if commands:
+            on_modify.perform(commands)
+
+
+if __name__ == "__main__":
+    run()
@@ -26,12 +26,17 @@
 #
 ###############################################################################
 
+import binascii
+import collections
+import enum
+import errno
 import json
-import subprocess
+import os
+import re
 import sys
 
 # Hook should extract all the following for use as Timewarrior tags:
-#   UUID
+#   UUID (see the UUID index instead)
 #   Project
 #   Tags
 #   Description
@@ -42,22 +47,43 @@ try:
 except AttributeError:
     input_stream = sys.stdin
 
+try:
+    output_stream = sys.stdout.buffer
+except AttributeError:
+    output_stream = sys.stdout
+
+
+def task_tags(json_obj):
+    if 'tags' not in json_obj:
+        return []
+
+    if type(json_obj['tags']) is str:
+        # Usage of tasklib (e.g. in taskpirate) converts the tag list into a string
+        # If this is the case, convert it back into a list first
+        # See https://github.com/tbabej/taskpirate/issues/11
+        return json_obj['tags'].split(',')
+
+    return json_obj['tags']
+
 
 def extract_tags_from(json_obj):
     # Extract attributes for use as tags.
     tags = [json_obj['description']]
+    rules = compiled_rules()
 
     if 'project' in json_obj:
-        tags.append(json_obj['project'])
-
-    if 'tags' in json_obj:
-        if type(json_obj['tags']) is str:
-            # Usage of tasklib (e.g. in taskpirate) converts the tag list into a string
-            # If this is the case, convert it back into a list first
-            # See https://github.com/tbabej/taskpirate/issues/11
-            tags.extend(json_obj['tags'].split(','))
+        if rules.project_split:
+            # 'a.b.c' is tagged 'a', 'a.b' and 'a.b.c'.
+            parts = json_obj['project'].split('.')
+            tags.extend('.'.join(parts[:index + 1]) for index in range(len(parts)))
         else:
-            tags.extend(json_obj['tags'])
+            tags.append(json_obj['project'])
+
+    tags.extend(task_tags(json_obj))
+
+    for uda in rules.uda_tags:
+        if uda in json_obj:
+            tags.append(format_value(json_obj[uda]))
 
     return tags
 
@@ -70,41 +96,1953 @@ def extract_annotation_from(json_obj):
     return json_obj['annotations'][0]['description']
 
 
-def main(old, new):
+# Fields of a task the hook looks at.
+TASK_FIELDS = ('start', 'end', 'description', 'project', 'tags', 'annotations', 'uuid', 'modified')
 
-    start_or_stop = ''
+decoder = json.JSONDecoder()
 
-    # Started task.
-    if 'start' in new and 'start' not in old:
-        start_or_stop = 'start'
 
-    # Stopped task.
-    elif ('start' not in new or 'end' in new) and 'start' in old:
-        start_or_stop = 'stop'
+def skip_whitespace(text, index):
+    while index < len(text) and text[index] in ' \t\r\n':
+        index += 1
 
-    if start_or_stop:
-        tags = extract_tags_from(new)
+    return index
 
-        subprocess.call(['timew', start_or_stop] + tags + [':yes'])
 
-    # Modifications to task other than start/stop
-    elif 'start' in new and 'start' in old:
-        old_tags = extract_tags_from(old)
-        new_tags = extract_tags_from(new)
+def find_value(text, key):
+    """Return where the value of key starts in a task's JSON, or -1.
+
+    A quoted key followed by a colon cannot be part of a JSON string, in which
+    its quotes would be escaped. Only the annotations of a task are nested
+    objects, so this finds top-level keys except for 'description', which
+    annotations have as well.
+    """
+    needle = '"{}"'.format(key)
+    index = text.find(needle)
+
+    while index != -1:
+        colon = skip_whitespace(text, index + len(needle))
+
+        if text[colon:colon + 1] == ':' and text[index - 1:index] != '\\':
+            return skip_whitespace(text, colon + 1)
+
+        index = text.find(needle, index + 1)
+
+    return -1
+
+
+def parse_task(text, fields=TASK_FIELDS):
+    """Parse only the given fields of a task's JSON.
+
+    Of the annotations, only the first one is parsed. Falls back to parsing
+    the whole task if the input is not laid out as expected. Small tasks are
+    parsed as a whole, which is quicker than looking for each field.
+    """
+    if len(text) < 4096:
+        return json.loads(text)
+
+    task = {}
+
+    try:
+        annotations_at = find_value(text, 'annotations')
+
+        for key in fields:
+            index = annotations_at if key == 'annotations' else find_value(text, key)
+
+            if index == -1:
+                continue
+
+            if key == 'annotations':
+                if text[index] != '[':
+                    raise ValueError('annotations are not a list')
+
+                index = skip_whitespace(text, index + 1)
+                task[key] = [] if text[index] == ']' else [decoder.raw_decode(text, index)[0]]
+
+            elif key == 'description' and annotations_at != -1 and index > annotations_at:
+                # This may be the description of an annotation.
+                raise ValueError('description follows annotations')
+
+            else:
+                task[key] = decoder.raw_decode(text, index)[0]
+
+    except (ValueError, IndexError):
+        return json.loads(text)
+
+    return task
+
+
+def normalize_annotation(annotation):
+    # An empty annotation is passed to timew as '' (see extract_annotation_from).
+    annotation = annotation.strip()
+
+    return '' if annotation == "''" else annotation
+
+
+def state_path():
+    # Directory for the small files the hook keeps between invocations.
+    path = os.environ.get('TIMEWARRIOR_HOOK_STATE')
+
+    if not path:
+        state_home = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+        path = os.path.join(state_home, 'timewarrior-hook')
+
+    return path
+
+
+def state_dir():
+    # state_path(), created if need be.
+    path = state_path()
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+
+def load_state(name, default=None):
+    try:
+        with open(os.path.join(state_dir(), name), 'rb') as state_file:
+            return json.loads(state_file.read().decode('utf-8'))
+    except (IOError, ValueError):
+        return default
+
+
+def save_state(name, data):
+    path = os.path.join(state_dir(), name)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(temp_path, 'wb') as state_file:
+        state_file.write(json.dumps(data).encode('utf-8'))
+
+    os.rename(temp_path, path)
+
+
+def resolve_timew():
+    """Return the path of the timew binary, or None if it is not installed.
+
+    The result of searching PATH is kept until PATH or the binary changes.
+    """
+    search_path = os.environ.get('PATH', os.defpath)
+    cached = load_state('timew.json', {})
+
+    if cached.get('PATH') == search_path and cached.get('path'):
+        try:
+            if os.stat(cached['path']).st_mtime == cached['mtime']:
+                return cached['path']
+        except OSError:
+            pass
+
+    import shutil
+
+    path = shutil.which('timew', path=search_path)
+
+    if path is not None:
+        save_state('timew.json', {'PATH': search_path, 'path': path, 'mtime': os.stat(path).st_mtime})
+
+    return path
+
+
+# Environment passed on to timew, everything else is left out.
+SPAWN_ENVIRONMENT = ('HOME', 'PATH', 'USER', 'LOGNAME', 'LANG', 'LANGUAGE', 'TZ', 'TERM',
+                     'TIMEWARRIORDB', 'XDG_CONFIG_HOME', 'XDG_DATA_HOME')
+
+
+# Exit code of a command killed at the deadline, as with timeout(1).
+TIMED_OUT = 124
+
+# Limits of the commands run by this process: 'deadline' is the time (as
+# time.time()) by which timew has to be done, None for no limit.
+limits = {'deadline': None}
+
+
+def wait_for(pid):
+    """Wait for a child process and return its exit code.
+
+    A child still running at the deadline is killed, and TIMED_OUT returned.
+    """
+    if limits['deadline'] is None:
+        status = os.waitpid(pid, 0)[1]
+    else:
+        import signal
+        import time
+
+        delay = 0.001
+
+        while True:
+            waited, status = os.waitpid(pid, os.WNOHANG)
+
+            if waited:
+                break
+
+            remaining = limits['deadline'] - time.time()
+
+            if remaining <= 0:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return TIMED_OUT
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+
+def spawn(cmd):
+    """Run a timew command and return its exit code.
+
+    Uses posix_spawn with the cached location of timew and a minimal
+    environment where available, subprocess.call otherwise.
+    """
+    path = resolve_timew() if cmd[0] == 'timew' else cmd[0]
+
+    if path is None:
+        raise OSError(errno.ENOENT, 'timew not found')
+
+    if not hasattr(os, 'posix_spawn'):
+        import subprocess
+        import time
+
+        timeout = None if limits['deadline'] is None else max(limits['deadline'] - time.time(), 0)
+
+        try:
+            return subprocess.call([path] + cmd[1:], timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return TIMED_OUT
+
+    environment = dict((key, value) for key, value in os.environ.items()
+                       if key in SPAWN_ENVIRONMENT or key.startswith('LC_'))
+
+    sys.stdout.flush()
+
+    return wait_for(os.posix_spawn(path, cmd, environment))
+
+
+def supports_retag():
+    # 'timew retag' exists since Timewarrior 1.7.0. The answer is cached
+    # until the timew binary changes.
+    if use_data_files():
+        return True
+
+    import subprocess
+
+    path = resolve_timew()
+
+    if path is None:
+        return False
+
+    key = [path, os.stat(path).st_mtime]
+    probe = load_state('probe.json', {})
+
+    if probe.get('key') != key:
+        try:
+            output = subprocess.check_output([path, '--version']).decode('utf-8', errors='replace')
+            version = tuple(int(part) for part in re.findall(r'\d+', output)[:3])
+        except (OSError, subprocess.CalledProcessError):
+            version = ()
+
+        probe = {'key': key, 'retag': version >= (1, 7, 0)}
+        save_state('probe.json', probe)
+
+    return probe['retag']
+
+
+def timew_db_dir():
+    # Same lookup as Timewarrior itself: $TIMEWARRIORDB, ~/.timewarrior, XDG.
+    if 'TIMEWARRIORDB' in os.environ:
+        return os.environ['TIMEWARRIORDB']
+
+    legacy_dir = os.path.expanduser('~/.timewarrior')
+
+    if os.path.isdir(legacy_dir):
+        return legacy_dir
+
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+
+    return os.path.join(data_home, 'timewarrior')
+
+
+def timew_config_path():
+    # Same lookup as Timewarrior itself: $TIMEWARRIORDB, ~/.timewarrior, XDG.
+    if 'TIMEWARRIORDB' in os.environ:
+        return os.path.join(os.environ['TIMEWARRIORDB'], 'timewarrior.cfg')
+
+    legacy_dir = os.path.expanduser('~/.timewarrior')
+
+    if os.path.isdir(legacy_dir):
+        return os.path.join(legacy_dir, 'timewarrior.cfg')
+
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+
+    return os.path.join(config_home, 'timewarrior', 'timewarrior.cfg')
+
+
+def taskrc_path():
+    # Taskwarrior passes its rc file to hooks as 'rc:<path>'.
+    for arg in sys.argv[1:]:
+        if arg.startswith('rc:'):
+            return arg[3:]
+
+    if 'TASKRC' in os.environ:
+        return os.environ['TASKRC']
+
+    legacy_path = os.path.expanduser('~/.taskrc')
+
+    if os.path.exists(legacy_path):
+        return legacy_path
+
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+
+    return os.path.join(config_home, 'task', 'taskrc')
+
+
+# Settings of the hook and their defaults. Each of them can be set in .taskrc
+# as 'timewarrior.hook.<name>', or as TIMEWARRIOR_HOOK_<NAME> in the
+# environment, which takes precedence.
+SETTINGS = {
+    'backend': 'timew',
+    'batch': '0',
+    'debounce': '0',
+    'debug': 'no',
+    'detach': 'no',
+    'dispatch': 'on_modify',
+    'interval_cache': 'yes',
+    'journal': 'no',
+    'ledger': 'no',
+    'project_split': 'no',
+    'timeout': '0',
+    'uda_tags': '',
+    'uuid_index': 'no',
+}
+
+# Rules deciding which tasks are tracked, set in .taskrc only:
+#   timewarrior.hook.include.project=<project>,...
+#   timewarrior.hook.exclude.tag=<tag>,...
+#   timewarrior.hook.exclude.uda.<name>=<value>,...
+RULE_KEY = re.compile(r'^timewarrior\.hook\.(include|exclude)\.(project|tag|uda\.[^.\s]+)$')
+
+
+def read_lines(path, sources):
+    # Lines of a configuration file, which becomes a source of the snapshot.
+    sources.append(path)
+
+    try:
+        with open(path, 'rb') as config_file:
+            return config_file.read().decode('utf-8', errors='replace').splitlines()
+    except IOError:
+        return []
+
+
+def read_taskrc(path, settings, rules, sources):
+    for line in read_lines(path, sources):
+        line = line.split('#', 1)[0].strip()
+
+        if line.startswith('include '):
+            included = os.path.expanduser(line[8:].strip())
+            read_taskrc(os.path.join(os.path.dirname(path), included), settings, rules, sources)
+            continue
+
+        key, _, value = line.partition('=')
+        key = key.strip()
+
+        if key.startswith('timewarrior.hook.') and key[17:] in SETTINGS:
+            settings[key[17:]] = value.strip()
+        elif RULE_KEY.match(key):
+            rules[key[17:]] = value.strip()
+
+
+def read_timew_config(path, settings, sources):
+    # Flattens 'define' blocks into dotted names, like 'timew show' does.
+    sections = []
+
+    for line in read_lines(path, sources):
+        line = line.split('#', 1)[0].rstrip()
+
+        if not line.strip():
+            continue
+
+        indent = len(line) - len(line.lstrip())
+        line = line.strip()
+
+        while sections and sections[-1][0] >= indent:
+            sections.pop()
+
+        if line.startswith('import '):
+            read_timew_config(os.path.expanduser(line[7:].strip()), settings, sources)
+        elif line.endswith(':'):
+            name = line[7:] if line.startswith('define ') else line
+            sections.append((indent, name[:-1].strip()))
+        elif '=' in line:
+            key, _, value = line.partition('=')
+            settings['.'.join([name for _, name in sections] + [key.strip()])] = value.strip()
+
+
+def stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [path, None, None, None]
+
+    return [path, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def config_environment():
+    environment = dict((key, value) for key, value in os.environ.items() if key.startswith('TIMEWARRIOR_HOOK_'))
+    environment['TIMEWARRIORDB'] = os.environ.get('TIMEWARRIORDB')
+    environment['taskrc'] = taskrc_path()
+
+    return environment
+
+
+def build_config(environment):
+    settings, rules, timew, sources = dict(SETTINGS), {}, {}, []
+    read_taskrc(environment['taskrc'], settings, rules, sources)
+    read_timew_config(timew_config_path(), timew, sources)
+
+    for name in SETTINGS:
+        value = environment.get('TIMEWARRIOR_HOOK_' + name.upper())
+
+        if value is not None:
+            settings[name] = value
+
+    import time
+
+    return {
+        'built': int(time.time() * 1e9),
+        'environment': environment,
+        'rules': rules,
+        'sources': [stat_key(path) for path in sources],
+        'settings': settings,
+        'timew': timew,
+    }
+
+
+def stale_source(snapshot, environment):
+    # What invalidates a configuration snapshot, None if it is still valid.
+    if snapshot.get('environment') != environment:
+        return 'environment'
+
+    for source in snapshot['sources']:
+        # A file changed right before the snapshot was built may change again
+        # without its size or modification time telling.
+        if stat_key(source[0]) != source or source[3] is not None and source[3] >= snapshot['built'] - 2000000000:
+            return source[0]
+
+    return None
+
+
+TRUE_VALUES = ('1', 'y', 'yes', 'on', 'true')
+
+# The snapshot used by this process, validated when it was first needed.
+loaded_config = {}
+
+
+def config():
+    """Return the configuration of the hook.
+
+    It is read from .taskrc, timewarrior.cfg and the environment once, and
+    kept in the state directory as a snapshot. Later invocations only stat
+    the source files to make sure the snapshot is still valid, once per
+    process; clear loaded_config to have it validated again.
+    """
+    if 'snapshot' in loaded_config:
+        return loaded_config['snapshot']
+
+    environment = config_environment()
+    snapshot = load_state('config.json', {})
+    stale = stale_source(snapshot, environment) if snapshot else 'no snapshot'
+
+    if stale is not None:
+        snapshot = build_config(environment)
+        snapshot['reason'] = stale
+        save_state('config.json', snapshot)
+
+        if snapshot['settings']['debug'].lower() in TRUE_VALUES:
+            sys.stderr.write('timewarrior hook: configuration reloaded ({})\n'.format(stale))
+
+    loaded_config['snapshot'] = snapshot
+
+    return snapshot
+
+
+def setting(name):
+    return config()['settings'][name]
+
+
+def enabled(name):
+    return setting(name).lower() in TRUE_VALUES
+
+
+def use_data_files():
+    # Exclusions are applied by timew only.
+    return setting('backend') == 'file' and not any(key.startswith('exclusions.') for key in config()['timew'])
+
+
+def format_value(value):
+    # JSON numbers become tags or rule values without a trailing '.0'.
+    if type(value) is float and value.is_integer():
+        value = int(value)
+
+    return value if type(value) is str else json.dumps(value)
+
+
+def split_values(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def compile_rule(name, value):
+    """Return a predicate on tasks for one include or exclude rule."""
+    values = split_values(value)
+
+    if name == 'project':
+        prefixes = tuple(prefix + '.' for prefix in values)
+        projects = frozenset(values)
+
+        return lambda task: task.get('project', '') in projects or task.get('project', '').startswith(prefixes)
+
+    if name == 'tag':
+        tags = frozenset(values)
+
+        return lambda task: not tags.isdisjoint(task_tags(task))
+
+    uda = name[4:]
+    uda_values = frozenset(values)
+
+    return lambda task: uda in task and format_value(task[uda]) in uda_values
+
+
+Rules = collections.namedtuple('Rules', 'include exclude fields uda_tags project_split')
+
+
+def compiled_rules():
+    """Return the tracking rules of the current configuration.
+
+    They are compiled into predicates once per configuration snapshot.
+    """
+    snapshot = config()
+    cached = loaded_config.get('rules')
+
+    if cached is not None and cached[0] == snapshot['built']:
+        return cached[1]
+
+    include, exclude, udas = [], [], []
+
+    for key, value in sorted(snapshot.get('rules', {}).items()):
+        kind, _, name = key.partition('.')
+        (include if kind == 'include' else exclude).append(compile_rule(name, value))
+
+        if name.startswith('uda.'):
+            udas.append(name[4:])
+
+    uda_tags = split_values(snapshot['settings']['uda_tags'])
+    fields = TASK_FIELDS + tuple(sorted(set(udas + uda_tags) - set(TASK_FIELDS)))
+    rules = Rules(include, exclude, fields, uda_tags, snapshot['settings']['project_split'].lower() in TRUE_VALUES)
+    loaded_config['rules'] = (snapshot['built'], rules)
+
+    return rules
+
+
+def tracked(task):
+    # Whether the rules let Timewarrior track the given task.
+    rules = compiled_rules()
+
+    if rules.include and not any(predicate(task) for predicate in rules.include):
+        return False
+
+    return not any(predicate(task) for predicate in rules.exclude)
+
+
+def task_fields():
+    # Fields of a task the hook and its rules look at.
+    return compiled_rules().fields
+
+
+TIMESTAMP = re.compile(r'^\d{8}T\d{6}Z$')
+MONTH_FILE = re.compile(r'^\d{4}-\d{2}\.data$')
+LINE_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+
+def quote_if_needed(tag):
+    # Mirrors quoteIfNeeded() in Timewarrior's src/util.cpp.
+    if '"' not in tag and ' ' not in tag and not any(c in tag for c in '+-/()<^!=~_%'):
+        return tag
+
+    return '"' + tag.replace('"', '\\"') + '"'
+
+
+def unquote(token):
+    # Timewarrior only escapes '"'; other backslashes are kept as they are.
+    if len(token) > 1 and token.startswith('"') and token.endswith('"'):
+        return token[1:-1].replace('\\"', '"')
+
+    return token
+
+
+class Interval(object):
+    """One line of a Timewarrior data file."""
+
+    def __init__(self, start, end=None, tags=(), annotation=''):
+        self.start = start
+        self.end = end
+        self.tags = set(tags)
+        self.annotation = annotation
+        # The line the interval was parsed from, if any.
+        self.line = None
+
+    @classmethod
+    def parse(cls, line):
+        tokens = LINE_TOKEN.findall(line)
+
+        if len(tokens) < 2 or tokens[0] != 'inc':
+            raise ValueError('Not an interval: {}'.format(line))
+
+        interval = cls(tokens[1])
+        interval.line = line
+        rest = tokens[2:]
+
+        if rest[:1] == ['-']:
+            interval.end = rest[1]
+            rest = rest[2:]
+
+        if rest[:1] == ['#']:
+            rest = rest[1:]
+
+            if '#' in rest:
+                annotation = rest[rest.index('#') + 1:]
+                rest = rest[:rest.index('#')]
+                interval.annotation = unquote(annotation[0]) if annotation else ''
+
+            interval.tags = set(unquote(tag) for tag in rest)
+
+        return interval
+
+    def serialize(self):
+        # Mirrors Interval::serialize() in Timewarrior's src/Interval.cpp.
+        line = 'inc ' + self.start
+
+        if self.end:
+            line += ' - ' + self.end
+
+        if self.tags:
+            line += ' #' + ''.join(' ' + quote_if_needed(tag) for tag in sorted(self.tags))
+
+        if self.annotation:
+            line += (' #' if not self.tags else '') + ' # "' + self.annotation.replace('"', '\\"') + '"'
+
+        return line
+
+
+class DataFileBackend(object):
+    """Apply timew commands directly to the Timewarrior data files.
+
+    Only the commands issued by this hook are understood: 'start', 'stop',
+    'tag', 'untag', 'retag' and 'annotate' of @1 or of the interval starting
+    at a time given as '@<start>', each with an optional leading timestamp,
+    and 'track <start> - <end>'. Exclusions, overlapping intervals
+    and Timewarrior's undo journal are not taken into account.
+    """
+
+    COMMANDS = ('start', 'stop', 'tag', 'untag', 'retag', 'annotate', 'track')
+
+    def __init__(self, db_dir):
+        self.data_dir = os.path.join(db_dir, 'data')
+
+    def __call__(self, cmd):
+        import fcntl
+
+        args = [arg for arg in cmd[1:] if not arg.startswith(':')]
+        command, args = args[0], args[1:]
+
+        if command not in self.COMMANDS:
+            sys.stderr.write("'{}' is not supported by the data file backend.\n".format(command))
+            return 1
+
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        with open(os.path.join(self.data_dir, '.timewarrior-hook.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._tag_counts = None
+
+            try:
+                return getattr(self, command)(args)
+            except Exception as error:
+                sys.stderr.write('{}\n'.format(error))
+                return 1
+            finally:
+                if self._tag_counts is not None:
+                    self._write_tag_counts()
+
+    def add(self, intervals):
+        """Add many intervals at once, reading and writing each data file once."""
+        import fcntl
+
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        with open(os.path.join(self.data_dir, '.timewarrior-hook.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._tag_counts = None
+            lines = collections.OrderedDict()
+
+            for interval in intervals:
+                lines.setdefault(self._month_file(interval.start), []).append(interval.serialize())
+                self._count_tags(interval.tags, 1)
+
+            for path, added in lines.items():
+                self._write(path, self._read(path) + added)
+
+            if self._tag_counts is not None:
+                self._write_tag_counts()
+
+    def start(self, args):
+        now, tags = self._split_time(args)
+        latest = self._latest()
+
+        if latest is not None and latest.end is None:
+            self._replace(latest, Interval(latest.start, now, latest.tags, latest.annotation))
+
+        self._add(Interval(now, tags=tags))
+        return 0
+
+    def stop(self, args):
+        now, tags = self._split_time(args)
+        latest = self._latest()
+
+        if latest is None or latest.end is not None:
+            raise RuntimeError('There is no active time tracking.')
+
+        for tag in tags:
+            if tag not in latest.tags:
+                raise RuntimeError("The current interval does not have the '{}' tag.".format(tag))
+
+        self._replace(latest, Interval(latest.start, now, latest.tags, latest.annotation))
+        remaining = latest.tags - set(tags) if tags else set()
+
+        if remaining:
+            self._add(Interval(now, tags=remaining))
+
+        return 0
+
+    def track(self, args):
+        if len(args) < 3 or args[1] != '-' or not TIMESTAMP.match(args[0]) or not TIMESTAMP.match(args[2]):
+            raise RuntimeError("Only 'track <start> - <end>' is supported by the data file backend.")
+
+        self._add(Interval(args[0], args[2], tags=args[3:]))
+        return 0
+
+    def tag(self, args):
+        latest = self._addressed(args)
+        self._replace(latest, Interval(latest.start, latest.end, latest.tags | set(args[1:]), latest.annotation))
+        return 0
+
+    def untag(self, args):
+        latest = self._addressed(args)
+        self._replace(latest, Interval(latest.start, latest.end, latest.tags - set(args[1:]), latest.annotation))
+        return 0
+
+    def retag(self, args):
+        latest = self._addressed(args)
+        self._replace(latest, Interval(latest.start, latest.end, args[1:], latest.annotation))
+        return 0
+
+    def annotate(self, args):
+        latest = self._addressed(args)
+        annotation = ' '.join(args[1:])
+        self._replace(latest, Interval(latest.start, latest.end, latest.tags, '' if annotation == "''" else annotation))
+        return 0
+
+    @staticmethod
+    def _split_time(args):
+        if args and TIMESTAMP.match(args[0]):
+            return args[0], args[1:]
+
+        import datetime
+
+        return datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'), args
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as data_file:
+                return [line for line in data_file.read().decode('utf-8').split('\n') if line]
+        except IOError:
+            return []
+
+    def _addressed(self, args):
+        if args and args[0].startswith('@') and TIMESTAMP.match(args[0][1:]):
+            # Only the file of the interval's month is read.
+            start = args[0][1:]
+
+            for line in self._read(self._month_file(start)):
+                if line.split(' ', 2)[1] == start:
+                    return Interval.parse(line)
+
+            raise RuntimeError('No interval starts at {}.'.format(start))
+
+        if not args or args[0] != '@1':
+            raise RuntimeError('Only @1 and @<start> can be addressed directly in the data files.')
+
+        latest = self._latest()
 
-        if old_tags != new_tags:
-            subprocess.call(['timew', 'untag', '@1'] + old_tags + [':yes'])
-            subprocess.call(['timew', 'tag', '@1'] + new_tags + [':yes'])
+        if latest is None:
+            raise RuntimeError('ID \'@1\' does not correspond to any tracking.')
+
+        return latest
+
+    def _month_file(self, timestamp):
+        return os.path.join(self.data_dir, '{}-{}.data'.format(timestamp[0:4], timestamp[4:6]))
+
+    def _write(self, path, lines):
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'wb') as data_file:
+            data_file.write(''.join(line + '\n' for line in sorted(lines)).encode('utf-8'))
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+        os.rename(temp_path, path)
+
+    def _latest(self):
+        return latest_interval(self.data_dir)
+
+    def _add(self, interval):
+        path = self._month_file(interval.start)
+        self._write(path, self._read(path) + [interval.serialize()])
+        self._count_tags(interval.tags, 1)
+
+    def _replace(self, old, new):
+        path = self._month_file(old.start)
+        lines = self._read(path)
+        # Timewarrior may have written the line differently from serialize().
+        lines.remove(old.serialize() if old.line is None else old.line)
+        self._write(path, lines + [new.serialize()])
+        self._count_tags(old.tags, -1)
+        self._count_tags(new.tags, 1)
+
+    def _count_tags(self, tags, delta):
+        if self._tag_counts is None:
+            try:
+                with open(os.path.join(self.data_dir, 'tags.data'), 'rb') as tags_file:
+                    self._tag_counts = json.loads(tags_file.read().decode('utf-8') or '{}')
+            except IOError:
+                self._tag_counts = {}
+
+        for tag in tags:
+            info = self._tag_counts.setdefault(tag, {'count': 0})
+            info['count'] = max(0, info['count'] + delta)
+
+    def _write_tag_counts(self):
+        # Same layout as TagInfoDatabase::toJson() in Timewarrior.
+        entries = ['\n  {}:{{"count":{}}}'.format(json.dumps(tag, ensure_ascii=False), info['count'])
+                   for tag, info in sorted(self._tag_counts.items())]
+        content = '{' + ','.join(entries) + ('\n' if entries else '') + '}'
+        path = os.path.join(self.data_dir, 'tags.data')
+
+        with open(path + '.tmp', 'wb') as tags_file:
+            tags_file.write(content.encode('utf-8'))
+
+        os.rename(path + '.tmp', path)
+
+
+def month_files(data_dir):
+    return sorted(name for name in os.listdir(data_dir) if MONTH_FILE.match(name))
+
+
+def latest_interval(data_dir):
+    # The interval @1 refers to, None if there is none.
+    for name in reversed(month_files(data_dir)):
+        lines = DataFileBackend._read(os.path.join(data_dir, name))
+
+        if lines:
+            return Interval.parse(max(lines))
+
+    return None
+
+
+def tracked_interval():
+    """Return whether the latest interval is known, and the interval itself.
+
+    The interval is cached in the state directory together with the identity,
+    size and modification time of the data files it was read from, and only
+    read from Timewarrior's data files again if one of them changed.
+    """
+    data_dir = os.path.join(timew_db_dir(), 'data')
+
+    try:
+        key = []
+
+        for name in reversed(month_files(data_dir)):
+            stat = os.stat(os.path.join(data_dir, name))
+            key.append([name, stat.st_ino, stat.st_size, stat.st_mtime_ns])
+
+            if stat.st_size > 0:
+                break
+    except OSError:
+        return False, None
+
+    cached = load_state('interval.json', {})
+
+    if cached.get('key') != key:
+        try:
+            interval = latest_interval(data_dir)
+        except (OSError, ValueError):
+            return False, None
+
+        cached = {'key': key, 'interval': interval and {
+            'start': interval.start,
+            'end': interval.end,
+            'tags': sorted(interval.tags),
+            'annotation': interval.annotation,
+        }}
+        save_state('interval.json', cached)
+
+    return True, cached['interval'] and Interval(**cached['interval'])
+
+
+def is_noop(cmd, interval):
+    """Tell whether a command would not change the given latest interval."""
+    verb = cmd[1]
+    args = [arg for arg in cmd[2:] if not arg.startswith(':')]
+
+    if verb == 'stop':
+        tags = set(DataFileBackend._split_time(args)[1])
+        return interval is None or interval.end is not None or not tags <= interval.tags
+
+    if verb not in ('tag', 'untag', 'retag', 'annotate') or args[:1] != ['@1']:
+        return False
+
+    if interval is None:
+        return True
+
+    if verb == 'annotate':
+        return normalize_annotation(' '.join(args[1:])) == interval.annotation
+
+    tags = set(args[1:])
+
+    if verb == 'tag':
+        return tags <= interval.tags
+
+    if verb == 'untag':
+        return not tags & interval.tags
+
+    return tags == interval.tags
+
+
+def execute(cmd):
+    # Run a single timew command with the backend selected for this install.
+    cmd = resolve_addresses(cmd)
+
+    if enabled('interval_cache'):
+        known, interval = tracked_interval()
+
+        if known and is_noop(cmd, interval):
+            return 0
+
+    if use_data_files():
+        return DataFileBackend(timew_db_dir())(cmd)
+
+    return spawn(cmd)
+
+
+class Transition(enum.Flag):
+    """What a modification means for Timewarrior."""
+
+    NOOP = 0
+    START = 1
+    STOP = 2
+    RETAG = 4
+    REANNOTATE = 8
+
+
+def transition_of(old_start, old_end, new_start, new_end, tags_equal, annotation_equal):
+    # Started task.
+    if new_start and not old_start:
+        return Transition.START
+
+    # Stopped task.
+    if old_start and (not new_start or new_end):
+        return Transition.STOP
+
+    # Modifications of a running task.
+    if old_start and new_start:
+        return ((Transition.NOOP if tags_equal else Transition.RETAG) |
+                (Transition.NOOP if annotation_equal else Transition.REANNOTATE))
+
+    return Transition.NOOP
+
+
+def transition_code(old_start, old_end, new_start, new_end, tags_equal, annotation_equal):
+    # Index into TRANSITIONS, one bit per condition.
+    return (old_start | old_end << 1 | new_start << 2 | new_end << 3 | tags_equal << 4 |
+            annotation_equal << 5)
+
+
+# The transition for each combination of conditions, by transition_code().
+TRANSITIONS = [transition_of(*[bool(code >> bit & 1) for bit in range(6)]) for code in range(64)]
+
+# The same as a bytes.translate() table.
+TRANSITION_TABLE = bytes(transition.value for transition in TRANSITIONS) + bytes(192)
+
+
+def classify(old, new):
+    """Tell what the modification of a task from old to new means for Timewarrior."""
+    old_start, new_start = 'start' in old, 'start' in new
+    tags_equal = annotation_equal = True
+
+    if old_start and new_start:
+        tags_equal = set(extract_tags_from(old)) == set(extract_tags_from(new))
+        annotation_equal = (normalize_annotation(extract_annotation_from(old)) ==
+                            normalize_annotation(extract_annotation_from(new)))
+
+    return TRANSITIONS[transition_code(old_start, 'end' in old, new_start, 'end' in new, tags_equal,
+                                       annotation_equal)]
+
+
+def classify_columns(old_start, old_end, new_start, new_end, tags_equal, annotation_equal):
+    """Classify many modifications at once.
+
+    Each argument is a column of the conditions classify() looks at, as a
+    bytes-like sequence of 0 and 1, one for each modification. Returns the
+    Transition values of the modifications as bytes. The columns are combined
+    as big integers and looked up with bytes.translate(), without a Python
+    loop over the modifications.
+    """
+    columns = (old_start, old_end, new_start, new_end, tags_equal, annotation_equal)
+    length = len(old_start)
+    codes = 0
+
+    for bit, column in enumerate(columns):
+        if len(column) != length:
+            raise ValueError('columns differ in length')
+
+        # Shifting stays within each byte, as the values are 0 or 1.
+        codes |= int.from_bytes(bytes(column), 'little') << bit
+
+    return codes.to_bytes(length, 'little').translate(TRANSITION_TABLE)
+
+
+def plan(old, new):
+    """Return the timew commands needed to follow a task from old to new."""
+    transition = classify(old, new)
+
+    if transition in (Transition.START, Transition.STOP):
+        start_or_stop = 'start' if transition == Transition.START else 'stop'
+        tags = extract_tags_from(new)
+
+        return [timed(['timew', start_or_stop] + tags + [':yes'], transition_time(start_or_stop, new))]
+
+    commands = []
+
+    if not transition:
+        return commands
+
+    # The running task's interval, see resolve_addresses().
+    target = '@' + new['uuid'] if uuid_index_enabled() and 'uuid' in new else '@1'
+
+    if transition & Transition.RETAG:
+        old_tags = extract_tags_from(old)
+        new_tags = extract_tags_from(new)
+
+        removed = [tag for tag in old_tags if tag not in new_tags]
+        added = [tag for tag in new_tags if tag not in old_tags]
+
+        if removed and added and supports_retag():
+            commands.append(['timew', 'retag', target] + new_tags + [':yes'])
+        else:
+            if removed:
+                commands.append(['timew', 'untag', target] + removed + [':yes'])
+
+            if added:
+                commands.append(['timew', 'tag', target] + added + [':yes'])
+
+    if transition & Transition.REANNOTATE:
+        commands.append(['timew', 'annotate', target, extract_annotation_from(new)])
+
+    return commands
+
+
+def transition_time(start_or_stop, new):
+    """Return when a task was started or stopped, in Timewarrior's format.
+
+    Starts and stops are passed to timew with the time they happened, so they
+    track the same time however late they are executed. Modifications of a
+    running interval address it by ID and cannot take a time.
+    """
+    if start_or_stop == 'start':
+        timestamp = new['start']
+    else:
+        # 'end' is only set if the task was completed or deleted.
+        timestamp = new.get('end') or new.get('modified')
+
+    if timestamp and TIMESTAMP.match(timestamp):
+        return timestamp
+
+    import time
+
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+
+
+def uuid_index_enabled():
+    return enabled('uuid_index')
+
+
+def update_index(old, new):
+    """Keep track of the interval of each running task.
+
+    The index maps the UUID of a running task to its start time, which is
+    where its interval starts as well.
+    """
+    if 'uuid' not in new:
+        return
+
+    running = 'start' in new and 'end' not in new
+    index = load_state('index.json', {})
+
+    if running and 'start' not in old:
+        index[new['uuid']] = new['start']
+    elif not running and 'start' in old:
+        index.pop(new['uuid'], None)
+    else:
+        return
+
+    save_state('index.json', index)
+
+
+def interval_id(uuid):
+    """Return the address of the interval of a running task, @1 if it is unknown.
+
+    The data file backend takes the start time the index holds as '@<start>'.
+    timew needs the ID: @1 while the task's interval is the latest one, which
+    the interval cache tells without reading the data files, and otherwise the
+    number of intervals which started since the task did, read from the data
+    files of the months since then.
+    """
+    start = load_state('index.json', {}).get(uuid)
+
+    if start is None:
+        return '@1'
+
+    if use_data_files():
+        return '@' + start
+
+    known, latest = tracked_interval()
+
+    if known and latest is not None and latest.start == start:
+        return '@1'
+
+    data_dir = os.path.join(timew_db_dir(), 'data')
+    count = 0
+
+    try:
+        for name in reversed(month_files(data_dir)):
+            if name[:4] + name[5:7] < start[:6]:
+                break
+
+            lines = DataFileBackend._read(os.path.join(data_dir, name))
+            count += sum(1 for line in lines if line.split(' ', 2)[1] >= start)
+    except OSError:
+        return '@1'
+
+    return '@{}'.format(count) if count else '@1'
+
+
+UUID_ADDRESS = re.compile(r'^@[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+
+def resolve_addresses(cmd):
+    # Replace the address of a task's interval by its current ID.
+    return [interval_id(arg[1:]) if UUID_ADDRESS.match(arg) else arg for arg in cmd]
+
+
+# Bounds of the ledger of processed modifications.
+LEDGER_SIZE = 1000
+LEDGER_AGE = 24 * 60 * 60
+
+
+def seen_before(new, commands):
+    """Record a modification in the ledger, and tell whether it was there.
+
+    A modification is identified by the task's UUID, its modification time
+    and the commands it results in. It is a replay if it is the last one
+    recorded for the task: 'modified' has a resolution of a second, so a
+    task started, stopped and started again within a second repeats the
+    identity of its first start. The ledger keeps the most recently seen
+    entries not older than LEDGER_AGE seconds, at most LEDGER_SIZE of them.
+    """
+    if 'uuid' not in new or 'modified' not in new:
+        return False
+
+    import hashlib
+    import time
+
+    now = time.time()
+    digest = hashlib.sha1(json.dumps(commands).encode('utf-8')).hexdigest()
+    key = '{} {} {}'.format(new['uuid'], new['modified'], digest)
+
+    ledger = collections.OrderedDict((entry_key, seen) for entry_key, seen in load_state('ledger.json', [])
+                                     if seen > now - LEDGER_AGE)
+    latest = next((entry_key for entry_key in reversed(ledger) if entry_key.startswith(new['uuid'] + ' ')), None)
+    duplicate = latest == key
+    ledger.pop(key, None)
+    ledger[key] = now
+
+    while len(ledger) > LEDGER_SIZE:
+        ledger.popitem(last=False)
+
+    save_state('ledger.json', list(ledger.items()))
+
+    return duplicate
+
+
+def commands_for(old, new):
+    # plan() plus the bookkeeping the planned commands rely on.
+
+    # A task which was running already is judged by its previous state.
+    if not tracked(old if 'start' in old else new):
+        return []
+
+    if uuid_index_enabled():
+        update_index(old, new)
+
+    commands = plan(old, new)
+
+    if commands and enabled('ledger') and seen_before(new, commands):
+        return []
+
+    return commands
+
+
+class QueueLock(object):
+    """Lock serializing invocations of the hook in the order they asked for it.
+
+    Waiting processes line up in a queue file in the state directory. The
+    first one in line holds the lock; those which died are skipped. The file
+    itself is only locked (flock) while it is read or updated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entry = '{} {}'.format(os.getpid(), binascii.hexlify(os.urandom(4)).decode('ascii'))
+        self.waited = 0.0
+
+    def _update(self, function):
+        import fcntl
+
+        with open(self.path, 'a+') as queue:
+            fcntl.flock(queue, fcntl.LOCK_EX)
+            queue.seek(0)
+            entries = [line for line in queue.read().split('\n') if line]
+            changed, result = function(entries)
+
+            if changed:
+                queue.seek(0)
+                queue.truncate()
+                queue.write(''.join(entry + '\n' for entry in entries))
+
+        return result
+
+    def _enqueue(self, entries):
+        entries.append(self.entry)
+        return True, None
+
+    def _first(self, entries):
+        changed = False
+
+        while entries and entries[0] != self.entry and not self._alive(entries[0]):
+            entries.pop(0)
+            changed = True
+
+        return changed, entries[:1] == [self.entry]
+
+    @staticmethod
+    def _alive(entry):
+        pid = entry.split(' ')[0]
+
+        # Anything else is left of a process which crashed while writing.
+        return pid.isdigit() and pid_alive(int(pid))
+
+    def _dequeue(self, entries):
+        entries.remove(self.entry)
+        return True, None
+
+    def __enter__(self):
+        import time
+
+        started = time.time()
+        delay = 0.001
+        self._update(self._enqueue)
+
+        while not self._update(self._first):
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+
+        self.waited = time.time() - started
+
+        if enabled('debug'):
+            sys.stderr.write('timewarrior hook: waited {:.3f}s for the lock\n'.format(self.waited))
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self._update(self._dequeue)
+
+
+def hook_lock():
+    # Held while a modification is planned and its commands executed or journaled.
+    return QueueLock(os.path.join(state_dir(), 'hook.queue'))
+
+
+def main(old, new):
+    with hook_lock():
+        commands = commands_for(old, new)
+
+        if commands:
+            perform(commands)
+
+
+def perform(commands):
+    # Run the commands of a modification, or leave them in the journal.
+    import time
+
+    timeout = float(setting('timeout') or 0)
+    limits['deadline'] = time.time() + timeout if timeout else None
+
+    try:
+        # Commands left over from an earlier invocation go first.
+        if enabled('journal') or queued():
+            journal(commands)
+
+            if not drain():
+                hand_off()
+
+            return
+
+        for index, cmd in enumerate(commands):
+            rc = execute(cmd)
+
+            if rc == TIMED_OUT:
+                journal(commands[index:])
+                hand_off()
+                break
+
+            if rc != 0:
+                record_failure(cmd, rc)
+    finally:
+        limits['deadline'] = None
+
+
+def is_running(task):
+    return 'start' in task and 'end' not in task
+
+
+def net_commands(chain):
+    """Return the commands with the net effect of a task's modifications.
+
+    chain holds the (old, new) pairs of one task, in order. An interval the
+    task started and stopped within the chain is started and stopped once,
+    with the tags and annotation it had when it was stopped, stopping whatever
+    was open as its start would; the interval of a task running before or
+    after the chain is only started, modified or stopped once.
+    """
+    first_old, last_new = chain[0][0], chain[-1][1]
+    running_before = is_running(first_old)
+    commands = []
+    started = None
+
+    for old, new in chain:
+        if 'start' in new and 'start' not in old:
+            started = new['start']
+
+        elif 'start' in old and ('start' not in new or 'end' in new):
+            stopped = transition_time('stop', new)
+
+            if started is None and running_before:
+                commands.extend(plan(first_old, old))
+                commands.append(timed(['timew', 'stop'] + extract_tags_from(new) + [':yes'], stopped))
+                running_before = False
+            elif started is not None:
+                commands.append(timed(['timew', 'start'] + extract_tags_from(old) + [':yes'], started))
+                annotation = normalize_annotation(extract_annotation_from(old))
+
+                if annotation:
+                    commands.append(['timew', 'annotate', '@1', annotation])
+
+                commands.append(timed(['timew', 'stop', ':yes'], stopped))
+
+            started = None
+
+    if running_before:
+        commands.extend(plan(first_old, last_new))
+    elif started is not None:
+        commands.append(timed(['timew', 'start'] + extract_tags_from(last_new) + [':yes'], started))
+        annotation = normalize_annotation(extract_annotation_from(last_new))
+
+        if annotation:
+            commands.append(['timew', 'annotate', '@1', annotation])
+
+    return commands
+
+
+def process_batch(pairs, execute=True):
+    """Follow a sequence of modifications with their net effect.
+
+    The (old, new) pairs are grouped by task UUID and each task's chain is
+    reduced to as few commands as possible (see net_commands()), in the order
+    the tasks first appear. The chains of different tasks are assumed not to
+    overlap in time. Returns the commands, after executing them if execute is
+    set.
+    """
+    chains = collections.OrderedDict()
+
+    for old, new in pairs:
+        chains.setdefault(new.get('uuid') or id(new), []).append((old, new))
+
+    with hook_lock():
+        commands = []
+
+        for chain in chains.values():
+            old, new = chain[0]
+
+            if tracked(old if 'start' in old else new):
+                commands.extend(net_commands(chain))
+
+        if commands and execute:
+            perform(commands)
+
+    return commands
+
+
+# Seconds to wait before each attempt to run commands which timed out.
+RETRY_DELAYS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def queued():
+    # Whether the journal holds commands which are still to be run.
+    try:
+        return os.path.getsize(os.path.join(state_dir(), 'journal')) > 0
+    except OSError:
+        return False
+
+
+def hand_off():
+    """Leave the journaled commands to a background process retrying them.
+
+    There is one such process at a time; while it is alive, it picks up
+    whatever was journaled since it was started.
+    """
+    sys.stderr.write('timewarrior hook: timew is busy or did not finish in time, retrying in the background\n')
+
+    retrying = load_state('retry.pid')
+
+    if retrying and pid_alive(retrying):
+        return
+
+    import subprocess
+
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'retry'], stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    save_state('retry.pid', process.pid)
+
+
+def retry():
+    """Drain the journal, backing off while timew keeps timing out.
+
+    Each command gets the configured timeout (or none) again. Whatever is
+    left after the last attempt is run by the next invocation of the hook.
+    """
+    import time
+
+    timeout = float(setting('timeout') or 0)
+
+    for delay in RETRY_DELAYS:
+        time.sleep(delay)
+
+        if drain(timeout=timeout):
+            return
+
+
+# Number of failed commands kept in failures.json.
+FAILURES_KEPT = 100
+
+
+def record_failure(cmd, rc):
+    """Keep the latest failed commands in failures.json in the state directory."""
+    import time
+
+    failures = load_state('failures.json', [])[-(FAILURES_KEPT - 1):]
+    failures.append({'cmd': cmd, 'rc': rc, 'time': time.time()})
+    save_state('failures.json', failures)
+
+
+def run_command(cmd):
+    # Like execute(), but a missing timew is reported as exit code 127.
+    try:
+        return execute(cmd)
+    except OSError:
+        return 127
+
+
+def command_time(cmd):
+    # When a timed start or stop takes effect, None for the time it is run.
+    return cmd[2] if cmd[1] in ('start', 'stop') and len(cmd) > 2 and TIMESTAMP.match(cmd[2]) else None
+
+
+def command_tags(cmd):
+    args = [arg for arg in cmd[2:] if not arg.startswith(':')]
+
+    return args[1:] if command_time(cmd) else args
+
+
+def timed(cmd, timestamp):
+    # A start or stop taking effect at the given time rather than when run.
+    return cmd[:2] + [timestamp] + cmd[2:] if cmd[1] in ('start', 'stop') and not command_time(cmd) else cmd
+
+
+def toggled_within(first, second, window):
+    # Whether two timed commands take effect at most window seconds apart.
+    if command_time(first) is None or command_time(second) is None:
+        return False
+
+    import calendar
+    import time
+
+    first_time, second_time = (calendar.timegm(time.strptime(command_time(cmd), '%Y%m%dT%H%M%SZ'))
+                               for cmd in (first, second))
+
+    return 0 <= second_time - first_time <= window
+
+
+def coalesce(commands, window=0):
+    """Reduce a sequence of commands to the same net effect on Timewarrior.
+
+    Consecutive modifications of @1 are merged into at most one untag, tag
+    (or retag) and annotate. A start followed by another start, with nothing
+    but modifications of @1 in between, would only leave an empty interval
+    behind and is dropped. Starts which take effect at a given time are kept.
+    A stop directly following a stop of the same interval, or of whatever
+    interval was running, is dropped.
+
+    A task stopped and started again within window seconds continues its
+    interval. A task started and stopped again within window seconds leaves
+    no interval behind; only the interval which was running before is
+    stopped, at the time the task was started. Pairs further apart, or
+    without times, are kept.
+    """
+    result = []
+    modifications = []
+
+    def flush_modifications():
+        added, removed, replaced, annotation = [], [], None, None
+
+        for cmd in modifications:
+            verb, tags = cmd[1], [arg for arg in cmd[3:] if not arg.startswith(':')]
+
+            if verb == 'annotate':
+                annotation = cmd
+            elif verb == 'retag':
+                added, removed, replaced = [], [], tags
+            elif replaced is not None:
+                replaced = [tag for tag in replaced if tag not in tags] + (tags if verb == 'tag' else [])
+            elif verb == 'tag':
+                removed = [tag for tag in removed if tag not in tags]
+                added = added + [tag for tag in tags if tag not in added]
+            elif verb == 'untag':
+                added = [tag for tag in added if tag not in tags]
+                removed = removed + [tag for tag in tags if tag not in removed]
+
+        if replaced is not None:
+            result.append(['timew', 'retag', '@1'] + replaced + [':yes'])
+        if removed:
+            result.append(['timew', 'untag', '@1'] + removed + [':yes'])
+        if added:
+            result.append(['timew', 'tag', '@1'] + added + [':yes'])
+        if annotation is not None:
+            result.append(annotation)
+
+        del modifications[:]
+
+    for cmd in commands:
+        verb = cmd[1]
+
+        if verb in ('tag', 'untag', 'retag', 'annotate') and cmd[2:3] == ['@1']:
+            modifications.append(cmd)
+            continue
+
+        previous = result[-1] if result else ['timew', None]
+
+        toggled = command_tags(previous) == command_tags(cmd) and toggled_within(previous, cmd, window)
+
+        if verb == 'stop' and previous[1] == 'start' and toggled:
+            result.pop()
+            del modifications[:]
+            cmd = ['timew', 'stop', command_time(previous), ':yes']
+
+        elif verb == 'start' and previous[1] == 'stop' and toggled:
+            result.pop()
+            flush_modifications()
+            continue
+
+        elif verb == 'start' and previous[1] == 'start' and command_time(previous) is None:
+            # Drop the previous start and whatever modified its interval.
+            result.pop()
+            del modifications[:]
+
+        flush_modifications()
+
+        if verb == 'stop' and result and result[-1][1] == 'stop':
+            if command_tags(result[-1]) in ([], command_tags(cmd)):
+                continue
+
+        result.append(cmd)
+
+    flush_modifications()
+
+    return result
+
+
+def append_to_journal(records):
+    # Append records to the journal and make sure they reached the disk.
+    import fcntl
+
+    with open(os.path.join(state_dir(), 'journal'), 'a+b') as journal:
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        journal.seek(0, os.SEEK_END)
+
+        # Start on a fresh line after a record torn by a crash.
+        if journal.tell() > 0:
+            journal.seek(-1, os.SEEK_END)
+
+            if journal.read(1) != b'\n':
+                data = b'\n' + data
+
+        journal.write(data)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def journal(commands):
+    """Record commands in the journal before they are executed by drain()."""
+    append_to_journal({'id': binascii.hexlify(os.urandom(8)).decode('ascii'), 'cmd': cmd} for cmd in commands)
+
+
+def pending_commands(journal_file):
+    # Commands without a matching completion record, in journal order.
+    pending = collections.OrderedDict()
+
+    for line in journal_file:
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            # Partially written record of a crashed process.
+            continue
+
+        if 'cmd' in record:
+            pending[record['id']] = record['cmd']
+        else:
+            pending.pop(record['id'], None)
+
+    return list(pending.items())
+
+
+def drain(coalesced=False, timeout=0):
+    """Execute all outstanding journal entries in the order they were recorded.
+
+    Each entry is marked done once timew returned, so entries interrupted by a
+    crash are replayed on the next call. Only one process drains at a time,
+    and it keeps going until nothing is left, so commands recorded meanwhile
+    are not left behind. The journal is emptied once everything is done.
+
+    If coalesced is set, the outstanding entries are reduced to their net
+    effect first (see coalesce()) and marked done together.
+
+    Returns whether the journal was emptied. It is not if a command timed out
+    (see limits), which then stays in the journal with all that follows, or
+    if a deadline is set and another process is draining already. If timeout
+    is given, each command has that many seconds.
+    """
+    import fcntl
+    import time
+
+    path = os.path.join(state_dir(), 'journal')
+
+    with open(path + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (fcntl.LOCK_NB if limits['deadline'] is not None else 0))
+        except (IOError, OSError):
+            return False
+
+        while True:
+            with open(path, 'a+b') as journal_file:
+                fcntl.flock(journal_file, fcntl.LOCK_EX)
+                journal_file.seek(0)
+                entries = pending_commands(journal_file)
+
+                if not entries:
+                    journal_file.truncate(0)
+                    return True
+
+            results = []
+
+            def run_timed(cmd):
+                if timeout:
+                    limits['deadline'] = time.time() + timeout
+
+                rc = run_command(cmd)
+
+                if timeout:
+                    limits['deadline'] = None
+
+                if rc not in (0, TIMED_OUT):
+                    record_failure(cmd, rc)
+
+                return rc
+
+            if coalesced:
+                commands = coalesce([cmd for entry_id, cmd in entries], float(setting('debounce') or 0))
+
+                for index, cmd in enumerate(commands):
+                    rc = run_timed(cmd)
+                    results.append({'cmd': cmd, 'rc': rc})
+
+                    if rc == TIMED_OUT:
+                        journal(commands[index:])
+                        break
+
+                append_to_journal({'id': entry_id, 'rc': None} for entry_id, cmd in entries)
+            else:
+                for entry_id, cmd in entries:
+                    rc = run_timed(cmd)
+                    results.append({'cmd': cmd, 'rc': rc})
+
+                    if rc == TIMED_OUT:
+                        break
+
+                    append_to_journal([{'id': entry_id, 'rc': rc}])
+
+            save_state('status.json', {
+                'pid': os.getpid(),
+                'finished': time.time(),
+                'failed': sum(1 for result in results if result['rc'] != 0),
+                'commands': results,
+            })
+
+            if results and results[-1]['rc'] == TIMED_OUT:
+                return False
+
+
+def run_detached(function):
+    """Run function in a child process Taskwarrior does not wait for.
+
+    The parent returns as soon as the child is forked, so a dispatcher can
+    go on with its other hooks; the child lets go of the terminal and of the
+    pipes to Taskwarrior before calling function.
+    """
+    sys.stdout.flush()
+    output_stream.flush()
+
+    if os.fork() != 0:
+        return
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+    try:
+        function()
+    finally:
+        os._exit(0)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+
+    return True
+
+
+def batch(window, quiet=0):
+    """Have journaled commands executed with those of the next moments.
+
+    The first invocation of a batch leaves a detached flusher behind which
+    waits until window seconds have passed or the calling task process has
+    exited, whichever comes first, and further until no command was journaled
+    for quiet seconds. It then executes the net effect of all commands
+    journaled in the meantime (see coalesce()).
+    """
+    import fcntl
+    import time
+
+    task_pid = os.getppid()
+    deadline = time.time() + window
+
+    with open(os.path.join(state_dir(), 'batch.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        flusher = load_state('batch.pid')
+
+        if flusher and pid_alive(flusher):
+            return
+
+        def flush():
+            save_state('batch.pid', os.getpid())
+            lock.close()
+
+            def waiting():
+                if time.time() < deadline and pid_alive(task_pid):
+                    return True
+
+                return time.time() < os.stat(os.path.join(state_dir(), 'journal')).st_mtime + quiet
+
+            while waiting():
+                time.sleep(0.02)
+
+            # Later invocations start a new batch from here on.
+            with open(os.path.join(state_dir(), 'batch.lock'), 'a') as flush_lock:
+                fcntl.flock(flush_lock, fcntl.LOCK_EX)
+                os.remove(os.path.join(state_dir(), 'batch.pid'))
+
+            drain(coalesced=True)
+
+        run_detached(flush)
+
+
+def socket_path():
+    # Location of the socket a running hook daemon listens on.
+    path = os.environ.get('TIMEWARRIOR_HOOK_SOCKET')
+
+    if path:
+        return path
+
+    # Not /tmp: anyone could put a socket there and receive our tasks.
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or state_path()
+
+    return os.path.join(runtime_dir, 'timewarrior-hook-{}.sock'.format(os.getuid()))
+
+
+def trusted_socket(path):
+    """Tell whether the socket and its directory belong to the current user alone.
+
+    Otherwise another user could have created it to read the tasks and to
+    reply with a task of their own, which would be echoed to Taskwarrior.
+    """
+    try:
+        socket_stat = os.stat(path)
+        dir_stat = os.stat(os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        return False
+
+    return (socket_stat.st_uid == os.getuid() and dir_stat.st_uid == os.getuid()
+            and not dir_stat.st_mode & 0o022)
+
+
+def forward(old_line, new_line, path):
+    """Hand both input lines over to a running hook daemon.
+
+    Returns everything the daemon sent back (the task followed by any output
+    of timew), or None if no daemon is listening on the given socket.
+    """
+    if not os.path.exists(path):
+        return None
+
+    import socket
+
+    if not hasattr(socket, 'AF_UNIX') or not trusted_socket(path):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+
+    # The daemon only serves hooks which are configured like itself.
+    environment = json.dumps(config_environment()).encode('utf-8')
+
+    with client:
+        for line in (old_line, new_line, environment):
+            client.sendall(line if line.endswith(b'\n') else line + b'\n')
+
+        client.shutdown(socket.SHUT_WR)
+        reply = b''.join(iter(lambda: client.recv(65536), b''))
+
+    # An empty reply means the daemon dropped the request before running it.
+    return reply or None
+
+
+def run():
+    """Process the modification Taskwarrior passes on stdin."""
+    if sys.argv[1:] == ['drain']:
+        drain()
+        return
+
+    if sys.argv[1:] == ['retry']:
+        retry()
+        return
+
+    old_line = input_stream.readline()
+    new_line = input_stream.readline()
+
+    reply = forward(old_line, new_line, socket_path())
+
+    if reply is not None:
+        output_stream.write(reply)
+        output_stream.flush()
+        return
+
+    # The task is not modified, so it is passed back exactly as it came in.
+    output_stream.write(new_line if new_line.endswith(b'\n') else new_line + b'\n')
+    output_stream.flush()
+
+    old_text = old_line.decode("utf-8", errors="replace")
+    new_text = new_line.decode("utf-8", errors="replace")
+
+    # Neither started nor stopped nor running: nothing to do for Timewarrior.
+    if find_value(old_text, 'start') == -1 and find_value(new_text, 'start') == -1:
+        return
+
+    process(parse_task(old_text, task_fields()), parse_task(new_text, task_fields()))
+
+
+def deferred():
+    # Whether timew runs in a background process, after the hook returned.
+    modes = float(setting('batch') or 0) or float(setting('debounce') or 0) or enabled('detach')
+
+    return bool(modes) and hasattr(os, 'fork')
+
+
+def process(old, new):
+    """Follow a modification in Timewarrior, as configured."""
+    if 'start' not in old and 'start' not in new:
+        return
+
+    if deferred():
+        with hook_lock():
+            commands = commands_for(old, new)
+
+            if commands:
+                journal(commands)
+
+        if not commands:
+            return
+
+        batch_window = float(setting('batch') or 0)
+        debounce_window = float(setting('debounce') or 0)
+
+        if batch_window or debounce_window:
+            batch(batch_window, debounce_window)
+        else:
+            run_detached(drain)
+    else:
+        main(old, new)
 
-        old_annotation = extract_annotation_from(old)
-        new_annotation = extract_annotation_from(new)
 
-        if old_annotation != new_annotation:
-            subprocess.call(['timew', 'annotate', '@1', new_annotation])
+def finish(old, new):
+    # Entry point for on_modify_dispatch.py, once the task is final.
+    process(old, new)
 
 
 if __name__ == "__main__":
-    old = json.loads(input_stream.readline().decode("utf-8", errors="replace"))
-    new = json.loads(input_stream.readline().decode("utf-8", errors="replace"))
-    print(json.dumps(new))
-    main(old, new)
+    run()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# Long-running companion of the on-modify hook.
+#
+# The daemon keeps `on_modify.main` loaded and serves the hook over a Unix
+# socket. A hook invocation which finds the socket forwards its two input
+# lines and echoes back whatever the daemon replies; without a daemon the hook
+# processes the modification itself.
+#
+# Requests are handled one at a time, in the order they arrive, so the
+# Timewarrior commands of consecutive modifications never interleave.
+#
+# A hook whose environment or rc: file differs from the daemon's, or which is
+# configured to batch, debounce or detach, is sent back without a reply and
+# processes the modification itself.
+
+import json
+import os
+import signal
+import socketserver
+import sys
+
+import on_modify
+
+
+class HookRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        old_line = self.rfile.readline()
+        new_line = self.rfile.readline()
+        environment_line = self.rfile.readline()
+
+        if not new_line:
+            return
+
+        # Settings may have changed since the last request.
+        on_modify.loaded_config.clear()
+
+        # Closing without a reply makes the client process the modification
+        # itself, with its own settings and in its own processes.
+        if not self.serves(environment_line):
+            return
+
+        fields = on_modify.task_fields()
+        old = on_modify.parse_task(old_line.decode("utf-8", errors="replace"), fields)
+        new = on_modify.parse_task(new_line.decode("utf-8", errors="replace"), fields)
+
+        self.wfile.write(new_line if new_line.endswith(b'\n') else new_line + b'\n')
+        self.wfile.flush()
+
+        # Whatever timew prints goes back to the client as feedback, just as
+        # it would if timew had been spawned by the hook itself.
+        sys.stdout.flush()
+        saved_stdout = os.dup(1)
+        os.dup2(self.connection.fileno(), 1)
+
+        try:
+            on_modify.main(old, new)
+        finally:
+            os.dup2(saved_stdout, 1)
+            os.close(saved_stdout)
+
+    @staticmethod
+    def serves(environment_line):
+        # The client's rc: argument and TIMEWARRIOR_HOOK_* variables have to
+        # be the daemon's, and modes which outlive the request are left to it.
+        try:
+            environment = json.loads(environment_line.decode('utf-8'))
+        except ValueError:
+            return False
+
+        own_environment = on_modify.config_environment()
+
+        for settings in (environment, own_environment):
+            settings.pop('TIMEWARRIOR_HOOK_SOCKET', None)
+
+        return environment == own_environment and not on_modify.deferred()
+
+
+class HookServer(socketserver.UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+        previous_umask = os.umask(0o177)
+
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(previous_umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def serve(path):
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with HookServer(path, HookRequestHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else on_modify.socket_path())
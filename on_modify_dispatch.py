@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# Runs several Python on-modify hooks in one interpreter.
+#
+# Install this file as the only `on-modify.*` hook and list the hook modules
+# in .taskrc, in the order they are to be run:
+#
+#     timewarrior.hook.dispatch=on_modify_priority,on_modify
+#
+# The modules are imported from the hooks directory. Each of them may define
+#
+#     hook(old, new)    returns the modified task, or None if it left new
+#                       alone; whatever it prints is passed on as feedback
+#     finish(old, new)  called with the final task once it went back to
+#                       Taskwarrior, for side effects like running timew
+#
+# The tasks are passed from one hook to the next as dicts, and the task is
+# only serialized again if a hook changed it. An exception raised by a hook
+# rejects the modification, like a hook exiting with an error would.
+
+import importlib
+import io
+import json
+import sys
+
+import on_modify
+
+
+def load_hooks():
+    return [importlib.import_module(name) for name in on_modify.split_values(on_modify.setting('dispatch'))]
+
+
+def dispatch(hooks, old_line, new_line):
+    """Run the hooks on a modification.
+
+    Returns the line to pass back to Taskwarrior, the feedback of the hooks
+    and the final task.
+    """
+    old = json.loads(old_line.decode('utf-8', errors='replace'))
+    new = json.loads(new_line.decode('utf-8', errors='replace'))
+    changed = False
+    feedback = io.StringIO()
+    stdout = sys.stdout
+    sys.stdout = feedback
+
+    try:
+        for module in hooks:
+            if hasattr(module, 'hook'):
+                result = module.hook(old, new)
+
+                if result is not None:
+                    new, changed = result, True
+    finally:
+        sys.stdout = stdout
+
+    if changed:
+        new_line = json.dumps(new, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    return new_line.rstrip(b'\n') + b'\n', feedback.getvalue().encode('utf-8'), old, new
+
+
+def run():
+    old_line = on_modify.input_stream.readline()
+    new_line = on_modify.input_stream.readline()
+
+    try:
+        hooks = load_hooks()
+        line, feedback, old, new = dispatch(hooks, old_line, new_line)
+    except Exception as error:
+        on_modify.output_stream.write('{}: {}\n'.format(type(error).__name__, error).encode('utf-8'))
+        on_modify.output_stream.flush()
+        sys.exit(1)
+
+    on_modify.output_stream.write(line + feedback)
+    on_modify.output_stream.flush()
+
+    for module in hooks:
+        if hasattr(module, 'finish'):
+            module.finish(old, new)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,42 @@
+#!/usr/bin/env -S python3 -S -E
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# Fast-start entry point of the on-modify hook.
+#
+# Install this file as `on-modify.timewarrior` next to `on_modify.py` and
+# precompile the latter:
+#
+#     python3 -m compileall -q ~/.task/hooks/on_modify.py
+#
+# Unlike the hook script itself, which is compiled on every run, the imported
+# module is loaded from its cached bytecode. The interpreter is started
+# without the site module (-S) and ignores PYTHON* variables (-E).
+
+import on_modify
+
+on_modify.run()
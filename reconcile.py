@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# Bring Timewarrior back in line with Taskwarrior after modifications the
+# hook did not see, e.g. of `task rc.hooks=off ...`.
+#
+#     python3 reconcile.py [--incremental] [--apply]
+#
+# The recent intervals of `timew export` are hashed by their tags, and the
+# tasks of `task export` are streamed past them, matched by the tags the hook
+# gives their intervals or, with the UUID index, by their start time. The
+# commands which make Timewarrior follow the tasks are printed, or run with
+# --apply.
+#
+# With --incremental only tasks which are active or were modified since the
+# last run with --apply are exported.
+
+import argparse
+import json
+import shlex
+import subprocess
+import sys
+import time
+
+import on_modify
+
+# Days of intervals looked at without a watermark.
+RECENT_DAYS = 7
+
+decoder = json.JSONDecoder()
+
+
+def iter_json(chunks):
+    """Yield the objects of a JSON array, decoding it as it is read."""
+    buffer = ''
+
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n[],':
+                position += 1
+
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                break
+
+            yield value
+
+        buffer = buffer[position:]
+
+    if buffer.strip(' \t\r\n[],'):
+        raise ValueError('Unexpected end of export: {}'.format(buffer[:80]))
+
+
+def export(cmd):
+    """Run an export command and yield the objects it prints."""
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    try:
+        for value in iter_json(line.decode('utf-8') for line in process.stdout):
+            yield value
+    finally:
+        process.stdout.close()
+
+        if process.wait() != 0:
+            raise RuntimeError('{} failed with exit code {}'.format(' '.join(cmd), process.returncode))
+
+
+def task_command(watermark=None):
+    cmd = ['task', 'rc.hooks=off', 'rc.verbose=nothing', 'rc.json.array=on']
+
+    if watermark is not None:
+        cmd.append('( +ACTIVE or modified.after:{} )'.format(watermark))
+
+    return cmd + ['export']
+
+
+def timew_command(since):
+    return ['timew', 'export', 'from', since]
+
+
+def reconcile(tasks, intervals, index=None):
+    """Return the commands which make Timewarrior follow the tasks.
+
+    intervals are those of 'timew export', tasks any number of the tasks of
+    'task export'. The latest started active task should be tracked by the
+    open interval. An open interval of a task which is no longer active is
+    stopped when the task was stopped, the latest such task stopped since
+    the interval started. An active task whose interval is not
+    open is started again when its last interval, or the one stopped for it,
+    ended, or when the task was started if there is none.
+    """
+    index = index or {}
+    by_tags = {}
+    by_start = {}
+
+    for interval in intervals:
+        by_tags.setdefault(frozenset(interval.get('tags', ())), []).append(interval)
+        by_start[interval['start']] = interval
+
+    open_interval = next((interval for interval in by_start.values() if 'end' not in interval), None)
+    expected = stopped = None
+
+    for task in tasks:
+        if not on_modify.tracked(task):
+            continue
+
+        tags = on_modify.extract_tags_from(task)
+        matches = list(by_tags.get(frozenset(tags), ()))
+        indexed = by_start.get(index.get(task.get('uuid')))
+
+        if indexed is not None and indexed not in matches:
+            matches.append(indexed)
+
+        if on_modify.is_running(task):
+            if expected is None or task['start'] > expected[0]['start']:
+                expected = (task, tags, matches)
+        elif open_interval is not None and any(match is open_interval for match in matches):
+            # Earlier instances of a recurring task share the tags.
+            stop_time = on_modify.transition_time('stop', task)
+
+            if stop_time >= open_interval['start'] and (stopped is None or stop_time > stopped[1]):
+                stopped = (task, stop_time)
+
+    commands = []
+    ends = []
+
+    if expected is not None and any(match is open_interval for match in expected[2]):
+        task, tags, matches = expected
+
+        interval_tags = open_interval.get('tags', [])
+        removed = [tag for tag in interval_tags if tag not in tags]
+        added = [tag for tag in tags if tag not in interval_tags]
+
+        # As in on_modify.plan().
+        if removed and added and on_modify.supports_retag():
+            commands.append(['timew', 'retag', '@1'] + tags + [':yes'])
+        else:
+            if removed:
+                commands.append(['timew', 'untag', '@1'] + removed + [':yes'])
+
+            if added:
+                commands.append(['timew', 'tag', '@1'] + added + [':yes'])
+
+        return commands
+
+    if stopped is not None:
+        ends.append(stopped[1])
+        commands.append(on_modify.timed(['timew', 'stop', ':yes'], ends[-1]))
+
+    if expected is not None:
+        task, tags, matches = expected
+        ends = [end for end in ends + [match.get('end', '') for match in matches] if end >= task['start']]
+        commands.append(on_modify.timed(['timew', 'start'] + tags + [':yes'], max(ends) if ends else task['start']))
+
+    return commands
+
+
+def watermarked(tasks, state):
+    # Pass the tasks on, keeping the latest modification time in state.
+    for task in tasks:
+        if task.get('modified', '') > state.get('watermark', ''):
+            state['watermark'] = task['modified']
+
+        yield task
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Bring Timewarrior in line with Taskwarrior.')
+    parser.add_argument('--incremental', action='store_true', help='only look at tasks modified since the last run')
+    parser.add_argument('--apply', action='store_true', help='run the commands instead of printing them')
+    args = parser.parse_args(argv)
+
+    state = on_modify.load_state('reconcile.json', {})
+    watermark = state.get('watermark') if args.incremental else None
+    since = watermark or time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(time.time() - RECENT_DAYS * 86400))
+
+    intervals = list(export(timew_command(since)))
+    tasks = watermarked(export(task_command(watermark)), state)
+    commands = reconcile(tasks, intervals, on_modify.load_state('index.json', {}))
+
+    if not args.apply:
+        for cmd in commands:
+            print(' '.join(shlex.quote(arg) for arg in cmd))
+        return
+
+    with on_modify.hook_lock():
+        if commands:
+            on_modify.perform(commands)
+
+    on_modify.save_state('reconcile.json', state)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
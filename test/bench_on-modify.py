@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+
+# Micro benchmarks of the on-modify hook.
+#
+#   PYTHONPATH=. python3 test/bench_on-modify.py
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import timeit
+
+import on_modify
+
+
+def large_task(annotations=5000, uda_size=200000):
+    task = {
+        "description": "Foo",
+        "entry": "20190820T201911Z",
+        "modified": "20190820T201911Z",
+        "project": "dummy",
+        "start": "20190820T201911Z",
+        "status": "pending",
+        "tags": ["abc", "xyz"],
+        "uda": "x" * uda_size,
+        "uuid": "3495a755-c4c6-4106-aabe-c0d3d128b65a",
+    }
+    task["annotations"] = [{"entry": "20190820T201911Z", "description": "Annotation {}".format(n)}
+                           for n in range(annotations)]
+
+    # Taskwarrior lists the annotations after all other attributes.
+    return json.dumps(task, separators=(',', ':'))
+
+
+def report(name, statement, number):
+    seconds = min(timeit.repeat(statement, number=number, repeat=5)) / number
+    print("{:<40} {:>10.1f} us".format(name, seconds * 1e6))
+
+
+def bench_parse():
+    for annotations, uda_size in ((0, 0), (100, 1000), (5000, 200000)):
+        text = large_task(annotations, uda_size)
+        print("task with {} annotations, {} bytes UDA ({} bytes)".format(annotations, uda_size, len(text)))
+        report("  json.loads", lambda: json.loads(text), 200)
+        report("  on_modify.parse_task", lambda: on_modify.parse_task(text), 200)
+
+
+def bench_spawn():
+    # A timew which does nothing, so only the cost of starting it is measured.
+    bin_dir = tempfile.mkdtemp(prefix="timew_")
+    os.symlink(shutil.which("true"), os.path.join(bin_dir, "timew"))
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["TIMEWARRIOR_HOOK_STATE"] = bin_dir
+
+    print("spawning timew")
+    report("  subprocess.call", lambda: subprocess.call(["timew", "start", "Foo", ":yes"]), 200)
+    report("  on_modify.spawn", lambda: on_modify.spawn(["timew", "start", "Foo", ":yes"]), 200)
+
+
+def bench_classify(rows=1000000):
+    columns = [os.urandom(rows).translate(bytes(byte & 1 for byte in range(256))) for bit in range(6)]
+    print("classifying {} modifications".format(rows))
+    report("  on_modify.transition_of", lambda: [on_modify.transition_of(*row) for row in zip(*columns)], 1)
+    report("  on_modify.classify_columns", lambda: on_modify.classify_columns(*columns), 1)
+
+
+if __name__ == "__main__":
+    bench_parse()
+    bench_spawn()
+    bench_classify()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import pytest
+from mockito import unstub
+
+import on_modify
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    """Keep the hook's state, Timewarrior's database and .taskrc in tmp_path."""
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_STATE", str(tmp_path / "state"))
+    monkeypatch.setenv("TIMEWARRIORDB", str(tmp_path / "timewarrior"))
+    monkeypatch.setenv("TASKRC", str(tmp_path / "taskrc"))
+    on_modify.loaded_config.clear()
+    yield tmp_path / "state"
+    unstub()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import io
+import json
+
+import pytest
+
+import backfill
+import on_modify
+
+FOO = 'description:"Foo" entry:"1566331151" status:"pending" uuid:"25b66283-96e0-42b4-b835-8efd0ea1043c"'
+BAR = 'description:"Bar &open;1&close; \\"x\\"" entry:"1566331151" project:"work" status:"pending" ' \
+      'uuid:"13f83e99-f6a2-4857-9e00-bdeede064772"'
+
+# 1566331200 is 20190820T200000Z.
+UNDO = (
+    'time 1566331151\nnew [{foo} modified:"1566331151"]\n---\n'
+    'time 1566331151\nnew [{bar} modified:"1566331151"]\n---\n'
+    'time 1566331200\nold [{foo} modified:"1566331151"]\n'
+    'new [{foo} modified:"1566331200" start:"1566331200"]\n---\n'
+    'time 1566331500\nold [{foo} modified:"1566331200" start:"1566331200"]\n'
+    'new [{foo} annotation_1566331500:"Note" modified:"1566331500" start:"1566331200" tags:"abc"]\n---\n'
+    'time 1566332100\nold [{foo} annotation_1566331500:"Note" modified:"1566331500" start:"1566331200" tags:"abc"]\n'
+    'new [{foo} annotation_1566331500:"Note" modified:"1566332100" tags:"abc"]\n---\n'
+    'time 1566334800\nold [{bar} modified:"1566331151"]\n'
+    'new [{bar} modified:"1566334800" start:"1566334800"]\n---\n'
+    'time 1566335400\nold [{foo} annotation_1566331500:"Note" modified:"1566332100" tags:"abc"]\n'
+    'new [{foo} annotation_1566331500:"Note" modified:"1566335400" start:"1566335400" tags:"abc"]\n---\n'
+    'time 1566336000\nold [{foo} annotation_1566331500:"Note" modified:"1566335400" start:"1566335400" tags:"abc"]\n'
+    'new [{foo} annotation_1566331500:"Note" end:"1566336000" modified:"1566336000" start:"1566335400" '
+    'status:"completed" tags:"abc"]\n---\n'
+).format(foo=FOO, bar=BAR)
+
+INTERVALS = (
+    'inc 20190820T200000Z - 20190820T201500Z # Foo abc # "Note"\n'
+    'inc 20190820T210000Z - 20190820T211000Z # "Bar [1] \\"x\\"" work\n'
+    'inc 20190820T211000Z - 20190820T212000Z # Foo abc # "Note"\n'
+)
+
+
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
+def test_parse_ff4_should_convert_task_to_hook_input():
+    """undo.data parser should turn FF4 tasks into the JSON form Taskwarrior passes to hooks"""
+
+    assert backfill.parse_ff4('[{} annotation_1566331500:"Note" start:"1566331200" tags:"abc,xyz"]'.format(BAR)) == {
+        "annotations": [{"entry": "20190820T200500Z", "description": "Note"}],
+        "description": 'Bar [1] "x"',
+        "entry": "20190820T195911Z",
+        "project": "work",
+        "start": "20190820T200000Z",
+        "status": "pending",
+        "tags": ["abc", "xyz"],
+        "uuid": "13f83e99-f6a2-4857-9e00-bdeede064772",
+    }
+
+
+def test_byte_ranges_should_end_with_transactions():
+    """undo.data should be split into ranges of whole transactions"""
+
+    data = UNDO.encode("utf-8")
+    ranges = list(backfill.byte_ranges(data, 100))
+
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == len(data)
+    assert all(data[start:end].endswith(b'\n---\n') for start, end in ranges)
+    assert all(previous[1] == following[0] for previous, following in zip(ranges, ranges[1:]))
+    assert len(ranges) > 3
+
+
+def test_backfill_should_write_intervals_with_original_times(tmp_path):
+    """backfill should write the intervals the hook would have recorded, parsed in parallel"""
+
+    undo = tmp_path / "undo.data"
+    undo.write_text(UNDO)
+
+    assert backfill.backfill(str(undo), str(tmp_path / "timewarrior"), processes=2, chunk_size=100) == 3
+    assert (tmp_path / "timewarrior" / "data" / "2019-08.data").read_text() == INTERVALS
+    assert json.loads((tmp_path / "timewarrior" / "data" / "tags.data").read_text())["Foo"] == {"count": 2}
+
+
+def test_backfill_should_stop_at_recorded_intervals(tmp_path):
+    """backfill should leave out intervals which end after the first one recorded by Timewarrior"""
+
+    undo = tmp_path / "undo.data"
+    undo.write_text(UNDO)
+    backend = on_modify.DataFileBackend(str(tmp_path / "timewarrior"))
+    backend(['timew', 'track', '20190820T211500Z', '-', '20190820T212000Z', 'Foo', 'abc', ':yes'])
+    output = io.StringIO()
+
+    assert backfill.backfill(str(undo), str(tmp_path / "timewarrior"), processes=1, output=output) == 2
+    assert output.getvalue() == "".join(INTERVALS.splitlines(True)[:2])
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import io
+import json
+
+import pytest
+from mockito import verify, when
+
+import on_exit
+import on_modify
+
+FOO = {"description": "Foo", "status": "pending", "uuid": "16af44c5-57d2-43bf-97ed-cf2e541d927f"}
+BAR = {"description": "Bar", "status": "pending", "uuid": "2f0e8c4f-6b52-4bb5-9d40-6ae3c1c0a0c3"}
+
+
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
+def run_on_exit(monkeypatch, tasks, argv=()):
+    monkeypatch.setattr(on_modify, "input_stream", io.BytesIO("".join(
+        json.dumps(task) + "\n" for task in tasks).encode("utf-8")))
+    monkeypatch.setattr(on_exit.sys, "argv", ["on_exit.py"] + list(argv))
+    on_exit.run()
+
+
+def test_on_exit_should_follow_all_tasks_of_a_command(monkeypatch):
+    """on-exit hook should rebuild each transition and run the combined commands once"""
+
+    when(on_modify).spawn(...).thenReturn(0)
+    foo = dict(FOO, start="20190820T203842Z")
+
+    run_on_exit(monkeypatch, [foo, BAR])
+    verify(on_modify, times=1).spawn(...)
+    verify(on_modify).spawn(['timew', 'start', '20190820T203842Z', 'Foo', ':yes'])
+
+    run_on_exit(monkeypatch, [dict(foo, tags=["abc"], modified="20190820T203900Z"),
+                              dict(BAR, start="20190820T203900Z", modified="20190820T203900Z")])
+    verify(on_modify).spawn(['timew', 'tag', '@1', 'abc', ':yes'])
+    verify(on_modify).spawn(['timew', 'start', '20190820T203900Z', 'Bar', ':yes'])
+
+    run_on_exit(monkeypatch, [dict(foo, tags=["abc"], end="20190820T204000Z", status="completed"),
+                              dict(BAR, modified="20190820T204000Z")])
+    verify(on_modify).spawn(['timew', 'stop', '20190820T204000Z', 'Foo', 'abc', ':yes'])
+    verify(on_modify).spawn(['timew', 'stop', '20190820T204000Z', 'Bar', ':yes'])
+    verify(on_modify, times=5).spawn(...)
+
+
+def test_on_exit_should_stop_seeded_running_task(monkeypatch):
+    """on-exit hook should know about tasks running before it was installed once seeded"""
+
+    when(on_modify).spawn(...).thenReturn(0)
+    running = dict(FOO, start="20190820T203842Z", tags=["abc"])
+    monkeypatch.setattr(on_modify, "input_stream", io.BytesIO(json.dumps([running, BAR]).encode("utf-8")))
+    monkeypatch.setattr(on_exit.sys, "argv", ["on_exit.py", "seed"])
+    on_exit.run()
+
+    run_on_exit(monkeypatch, [dict(FOO, tags=["abc"], modified="20190820T204000Z")])
+
+    verify(on_modify, times=1).spawn(...)
+    verify(on_modify).spawn(['timew', 'stop', '20190820T204000Z', 'Foo', 'abc', ':yes'])
+
+
+def test_on_exit_should_leave_ended_task_alone(monkeypatch):
+    """on-exit hook should not start a completed task which had been started, when it is modified"""
+
+    when(on_modify).spawn(...).thenReturn(0)
+    done = dict(FOO, start="20190820T201912Z", end="20190820T203000Z", status="completed")
+
+    assert on_exit.commands_for([dict(done, annotations=[{"entry": "20191120T100000Z", "description": "Note"}])]) == []
+    verify(on_modify, times=0).spawn(...)
+
+
+def test_on_exit_should_replace_invalid_utf8(monkeypatch):
+    """on-exit hook should read tasks with non-UTF-8 characters rather than fail"""
+
+    monkeypatch.setattr(on_modify, "input_stream", io.BytesIO(b'{"description": "Foo \xe9"}\n'))
+
+    assert on_exit.read_tasks() == [{"description": "Foo \ufffd"}]
+
+
+def test_on_exit_should_do_nothing_without_tasks(monkeypatch, state_dir):
+    """on-exit hook should neither lock nor touch its state for commands which modified nothing"""
+
+    when(on_modify).hook_lock().thenRaise(AssertionError("hook_lock taken"))
+
+    run_on_exit(monkeypatch, [])
+
+    assert not state_dir.exists()
+
+
+def test_on_exit_should_keep_running_tasks_unless_changed(monkeypatch):
+    """on-exit hook should only write running.json if a running task changed"""
+
+    when(on_modify).spawn(...).thenReturn(0)
+    run_on_exit(monkeypatch, [dict(FOO, start="20190820T203842Z")])
+    when(on_modify).save_state("running.json", ...).thenRaise(AssertionError("running.json written"))
+
+    run_on_exit(monkeypatch, [dict(BAR, description="Bar Baz")])
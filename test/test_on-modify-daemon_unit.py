@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import json
+import os
+import socket
+import threading
+
+import pytest
+from mockito import verify, when
+
+import on_modify
+import on_modify_daemon
+
+
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    path = str(tmp_path / "hook.sock")
+    server = on_modify_daemon.HookServer(path, on_modify_daemon.HookRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_forward_without_daemon_should_return_none(tmp_path):
+    """hook client should fall back when no daemon is listening"""
+
+    assert on_modify.forward(b'{}\n', b'{}\n', str(tmp_path / "missing.sock")) is None
+
+
+def test_forward_to_stale_socket_should_return_none(tmp_path):
+    """hook client should fall back when the socket is left over from a dead daemon"""
+
+    path = str(tmp_path / "stale.sock")
+    server = on_modify_daemon.HookServer(path, on_modify_daemon.HookRequestHandler)
+    server.socket.close()
+
+    assert os.path.exists(path)
+    assert on_modify.forward(b'{}\n', b'{}\n', path) is None
+
+
+def test_daemon_should_echo_task_and_process_start(daemon):
+    """hook daemon should echo the modified task and run the start command"""
+
+    when(on_modify).spawn(...).thenReturn(0)
+    old_line = b'{"description": "Foo", "status": "pending", "uuid": "16af44c5-57d2-43bf-97ed-cf2e541d927f"}'
+    new_line = b'{"description": "Foo", "start": "20190820T203842Z", "status": "pending", ' \
+               b'"uuid": "16af44c5-57d2-43bf-97ed-cf2e541d927f"}'
+
+    reply = on_modify.forward(old_line, new_line, daemon)
+
+    assert json.loads(reply.decode('utf-8').splitlines()[0]) == json.loads(new_line.decode('utf-8'))
+    verify(on_modify).spawn(['timew', 'start', '20190820T203842Z', 'Foo', ':yes'])
+
+
+def test_daemon_socket_should_be_private(daemon):
+    """hook daemon socket should only be accessible by its owner"""
+
+    assert os.stat(daemon).st_mode & 0o077 == 0
+
+
+def test_forward_should_ignore_socket_in_shared_directory(daemon, tmp_path):
+    """hook client should not talk to a socket in a directory other users can write to"""
+
+    os.chmod(str(tmp_path), 0o1777)
+
+    try:
+        assert on_modify.forward(b'{}\n', b'{}\n', daemon) is None
+    finally:
+        os.chmod(str(tmp_path), 0o700)
+
+
+def test_forward_should_ignore_socket_of_other_user(daemon):
+    """hook client should not talk to a socket owned by another user"""
+
+    other_uid = os.getuid() + 1
+    when(os).getuid().thenReturn(other_uid)
+
+    assert on_modify.forward(b'{}\n', b'{}\n', daemon) is None
+
+
+def test_daemon_should_leave_differently_configured_hook_alone(daemon):
+    """hook daemon should not process modifications of hooks with other settings"""
+
+    environment = dict(on_modify.config_environment(), taskrc="/elsewhere/taskrc")
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(daemon)
+
+    with client:
+        client.sendall(b'{}\n{"start": "20190820T203842Z"}\n' + json.dumps(environment).encode('utf-8') + b'\n')
+        client.shutdown(socket.SHUT_WR)
+
+        assert client.recv(65536) == b''
+
+
+def test_daemon_should_leave_detached_mode_to_hook(daemon, monkeypatch):
+    """hook daemon should not process modifications the hook would detach"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_DETACH", "yes")
+
+    assert on_modify.forward(b'{}\n', b'{"start": "20190820T203842Z"}\n', daemon) is None
+
+
+def test_socket_path_should_not_create_state_directory(tmp_path, monkeypatch):
+    """looking for a daemon should leave the file system alone"""
+
+    monkeypatch.delenv("TIMEWARRIOR_HOOK_SOCKET", raising=False)
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+
+    assert on_modify.socket_path().startswith(str(tmp_path / "state"))
+    assert not (tmp_path / "state").exists()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import json
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+import on_modify_dispatch
+
+OLD = b'{"description":"Foo","status":"pending","uuid":"16af44c5-57d2-43bf-97ed-cf2e541d927f"}'
+NEW = b'{"description":"Foo", "start":"20190820T203842Z","status":"pending","uuid":"16af44c5-57d2-43bf-97ed-cf2e541d927f"}'
+
+
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
+def test_dispatch_should_pass_tasks_from_hook_to_hook():
+    """dispatcher should hand the task each hook returned to the next one and serialize it once"""
+
+    seen = []
+
+    def prioritize(old, new):
+        print("Priority set")
+        return dict(new, priority="H")
+
+    def check(old, new):
+        seen.append(new)
+
+    hooks = [types.SimpleNamespace(hook=prioritize), types.SimpleNamespace(hook=check)]
+    line, feedback, old, new = on_modify_dispatch.dispatch(hooks, OLD + b'\n', NEW + b'\n')
+
+    assert seen == [new]
+    assert seen[0] is new
+    assert json.loads(line.decode("utf-8")) == dict(json.loads(NEW.decode("utf-8")), priority="H")
+    assert line.count(b'\n') == 1
+    assert feedback == b"Priority set\n"
+
+
+def test_dispatch_should_pass_unchanged_task_through():
+    """dispatcher should return the task byte for byte if no hook changed it"""
+
+    hooks = [types.SimpleNamespace(hook=lambda old, new: None), types.SimpleNamespace()]
+
+    assert on_modify_dispatch.dispatch(hooks, OLD, NEW)[:2] == (NEW + b'\n', b'')
+
+
+def test_dispatch_should_replace_invalid_utf8():
+    """dispatcher should pass a task with non-UTF-8 characters on rather than reject it"""
+
+    new = NEW.replace(b'"Foo"', b'"Foo \xe9"')
+    hooks = [types.SimpleNamespace(hook=lambda old, new: None)]
+    line, feedback, old, task = on_modify_dispatch.dispatch(hooks, OLD, new)
+
+    assert line == new + b'\n'
+    assert task["description"] == "Foo \ufffd"
+
+
+def run_dispatcher(tmp_path, hooks, **env):
+    (tmp_path / "hook_priority.py").write_text(
+        "def hook(old, new):\n"
+        "    print('Priority set')\n"
+        "    return dict(new, priority='H')\n")
+    (tmp_path / "hook_failing.py").write_text(
+        "def hook(old, new):\n"
+        "    raise ValueError('no modifications on Fridays')\n")
+    (tmp_path / "taskrc").write_text("timewarrior.hook.dispatch={}\ntimewarrior.hook.backend=file\n".format(hooks))
+    (tmp_path / "hook_finished.py").write_text(
+        "def finish(old, new):\n"
+        "    open('{}', 'w').write(new['description'])\n".format(tmp_path / "finished"))
+    env = dict(os.environ, PYTHONPATH=str(tmp_path), TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"), **env)
+
+    return subprocess.run([sys.executable, on_modify_dispatch.__file__], input=OLD + b'\n' + NEW + b'\n', env=env,
+                          stdout=subprocess.PIPE)
+
+
+def test_dispatcher_should_run_hooks_in_one_process(tmp_path):
+    """dispatcher should run the configured hooks and have Timewarrior follow the final task"""
+
+    result = run_dispatcher(tmp_path, "hook_priority, on_modify")
+    lines = result.stdout.decode("utf-8").splitlines()
+
+    assert result.returncode == 0
+    assert json.loads(lines[0])["priority"] == "H"
+    assert lines[1:] == ["Priority set"]
+    assert (tmp_path / "timewarrior" / "data" / "2019-08.data").read_text() == "inc 20190820T203842Z # Foo\n"
+
+
+def test_dispatcher_should_reject_modification_if_hook_fails(tmp_path):
+    """dispatcher should exit with an error, and not run timew, if a hook raises an exception"""
+
+    result = run_dispatcher(tmp_path, "hook_failing,on_modify")
+
+    assert result.returncode == 1
+    assert result.stdout == b"ValueError: no modifications on Fridays\n"
+    assert not (tmp_path / "timewarrior" / "data").exists()
+
+
+def test_dispatcher_should_finish_hooks_after_detached_hook(tmp_path):
+    """dispatcher should still finish the hooks after on_modify when it detaches"""
+
+    result = run_dispatcher(tmp_path, "on_modify,hook_finished", TIMEWARRIOR_HOOK_DETACH="yes")
+
+    assert result.returncode == 0
+    assert (tmp_path / "finished").read_text() == "Foo"
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import pytest
+
+import on_modify
+
+REPO_DIR = os.path.dirname(os.path.abspath(on_modify.__file__))
+FAST_HOOK = os.path.join(REPO_DIR, "on_modify_fast.py")
+
+# Modules a modification must not pay for before it actually runs timew.
+DEFERRED_MODULES = ["datetime", "subprocess", "socket", "shutil", "fcntl"]
+
+# Modules on_modify imports as it is loaded.
+EAGER_MODULES = "binascii, collections, enum, errno, json, os, re, sys"
+
+# Time the hook may take on top of importing EAGER_MODULES, in milliseconds.
+# Importing on_modify itself takes some 4 ms, loading the deferred modules
+# eagerly again some 20 ms more.
+IMPORT_MARGIN = 8
+STARTUP_MARGIN = 10
+
+NOOP_MODIFICATION = b'{"description": "Foo", "status": "pending"}\n' \
+                    b'{"description": "Foo Bar", "status": "pending"}\n'
+
+
+def import_times(modules="on_modify"):
+    output = subprocess.run([sys.executable, "-S", "-E", "-X", "importtime", "-c", "import " + modules],
+                            cwd=REPO_DIR, stderr=subprocess.PIPE, check=True).stderr.decode("utf-8")
+    times = {}
+
+    for line in output.splitlines()[1:]:
+        self_time, cumulative, name = line.split(":", 1)[1].split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def total_import_time(modules):
+    # Of the modules imported by the statement itself, not by other modules.
+    times = import_times(modules)
+
+    return sum(times[name] for name in modules.split(", ") if name in times) / 1000
+
+
+def wall_clock(args, stdin=b"", env=None, runs=15):
+    durations = []
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(args, input=stdin, stdout=subprocess.DEVNULL, cwd=REPO_DIR, env=env, check=True)
+        durations.append(time.perf_counter() - started)
+
+    return statistics.median(durations) * 1000
+
+
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
+@pytest.fixture
+def hook_env(tmp_path):
+    # Neither a real state directory nor a running daemon.
+    return dict(os.environ, TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"))
+
+
+@pytest.fixture(scope="module", autouse=True)
+def compiled():
+    # The fast-start hook relies on on_modify being precompiled.
+    subprocess.run([sys.executable, "-m", "compileall", "-q", os.path.join(REPO_DIR, "on_modify.py")], check=True)
+
+
+def test_import_should_not_load_deferred_modules():
+    """importing the hook should not load modules only needed to run timew"""
+
+    loaded = import_times()
+
+    for name in DEFERRED_MODULES:
+        assert name not in loaded
+
+
+def test_import_should_stay_within_budget():
+    """importing the hook should stay within its time budget"""
+
+    baseline = min(total_import_time(EAGER_MODULES) for _ in range(5))
+    hook = min(total_import_time("on_modify") for _ in range(5))
+
+    assert hook - baseline < IMPORT_MARGIN
+
+
+def test_fast_hook_should_echo_task(hook_env):
+    """fast-start hook should behave like the hook script"""
+
+    output = subprocess.run([FAST_HOOK], input=NOOP_MODIFICATION, env=hook_env, stdout=subprocess.PIPE,
+                            check=True).stdout
+
+    assert output == b'{"description": "Foo Bar", "status": "pending"}\n'
+
+
+def test_fast_hook_startup_should_stay_within_budget(hook_env):
+    """fast-start hook should add little to an interpreter importing what the hook needs"""
+
+    baseline = wall_clock([sys.executable, "-S", "-E", "-c", "import " + EAGER_MODULES], env=hook_env)
+    hook = wall_clock([sys.executable, "-S", "-E", FAST_HOOK], NOOP_MODIFICATION, env=hook_env)
+
+    assert hook - baseline < STARTUP_MARGIN
@@ -27,9 +27,15 @@
 ###############################################################################
 
 import os.path
+import sys
+import tempfile
 
 from basetest import Timew, Task, TestCase
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import on_modify  # noqa: E402
+
 
 class TestOnModifyHookScript(TestCase):
 
@@ -201,3 +207,48 @@ class TestOnModifyHookScript(TestCase):
         j = self.timew.export()
         self.assertEqual(len(j), 1)
         self.assertClosedInterval(j[0], expectedTags=["Foo"])
+
+
+class TestDataFileBackend(TestCase):
+
+    COMMANDS = [
+        ["start", "20190820T201911Z", "Foo Bar", "abc", ":yes"],
+        ["annotate", "@1", "Annotation"],
+        ["untag", "@1", "abc", ":yes"],
+        ["annotate", "@1", "C:\\temp\\x"],
+        ["tag", "@1", "abc", ":yes"],
+        ["tag", "@1", "x-y", ":yes"],
+        ["start", "20190820T203000Z", "Baz", ":yes"],
+        ["stop", "20190820T204500Z", "Baz", ":yes"],
+        ["start", "20190831T235000Z", "Foo", "abc", ":yes"],
+        ["stop", "20190901T001000Z", "Foo", ":yes"],
+        ["annotate", "@1", "''"],
+    ]
+
+    def setUp(self):
+        if os.path.exists("/root/.local/share/timewarrior"):
+            datadir = "/root/.local/share/timewarrior"
+            configdir = "/root/.config/timewarrior"
+        else:
+            datadir = "/root/.timewarrior"
+            configdir = "/root/.timewarrior"
+
+        self.timew = Timew(datadir=datadir, configdir=configdir)
+        self.timew.reset(keep_config=True)
+
+    @staticmethod
+    def read_data_files(data_dir):
+        return {name: open(os.path.join(data_dir, name)).read()
+                for name in sorted(os.listdir(data_dir)) if name.endswith(".data") and name != "undo.data"}
+
+    def test_data_file_backend_should_match_timew(self):
+        """data file backend should produce the same data files as timew"""
+        backend_dir = tempfile.mkdtemp(prefix="timew_")
+        backend = on_modify.DataFileBackend(backend_dir)
+
+        for command in self.COMMANDS:
+            self.timew(command)
+            self.assertEqual(backend(["timew"] + command), 0)
+
+        self.assertEqual(self.read_data_files(os.path.join(self.timew.datadir, "data")),
+                         self.read_data_files(os.path.join(backend_dir, "data")))
@@ -26,7 +26,12 @@
 #
 ###############################################################################
 import json
+import os
+import re
+import shutil
 import subprocess
+import sys
+import time
 
 import pytest
 from mockito import unstub, verify, when
@@ -40,11 +45,14 @@ def teardown():
     unstub()
 
 
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_annotate():
     """on-modify hook should process 'task annotate'"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -67,14 +75,15 @@ def test_hook_should_process_annotate():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'annotate', '@1', 'Annotation'])
+    verify(on_modify).spawn(['timew', 'annotate', '@1', 'Annotation'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_append():
     """on-modify hook should process 'task append'"""
 
-    when(subprocess).call(...)
+    when(on_modify).supports_retag().thenReturn(False)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -96,15 +105,15 @@ def test_hook_should_process_append():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'untag', '@1', 'Foo', ':yes'])
-    verify(subprocess).call(['timew', 'tag', '@1', 'Foo Bar', ':yes'])
+    verify(on_modify).spawn(['timew', 'untag', '@1', 'Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'tag', '@1', 'Foo Bar', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_delete():
     """on-modify hook should process 'task delete'"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -127,14 +136,14 @@ def test_hook_should_process_delete():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'stop', 'Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'stop', '20190820T201911Z', 'Foo', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_denotate():
     """on-modify hook should process 'task denotate'"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -157,14 +166,14 @@ def test_hook_should_process_denotate():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'annotate', '@1', "''"])
+    verify(on_modify).spawn(['timew', 'annotate', '@1', "''"])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_done():
     """on-modify hook should process 'task done'"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -186,14 +195,15 @@ def test_hook_should_process_done():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'stop', 'Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'stop', '20190820T201912Z', 'Foo', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_modify_desc():
     """on-modify hook should process 'task modify' for changing description"""
 
-    when(subprocess).call(...)
+    when(on_modify).supports_retag().thenReturn(False)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -215,15 +225,16 @@ def test_hook_should_process_modify_desc():
             }''')
     )
 
-    verify(subprocess).call(["timew", "untag", "@1", "Foo", ":yes"])
-    verify(subprocess).call(['timew', 'tag', '@1', 'Bar', ':yes'])
+    verify(on_modify).spawn(["timew", "untag", "@1", "Foo", ":yes"])
+    verify(on_modify).spawn(['timew', 'tag', '@1', 'Bar', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_modify_tags():
     """on-modify hook should process 'task modify' for changing tags"""
 
-    when(subprocess).call(...)
+    when(on_modify).supports_retag().thenReturn(False)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -247,15 +258,16 @@ def test_hook_should_process_modify_tags():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'untag', '@1', 'Foo', 'Tag', 'Bar', ':yes'])
-    verify(subprocess).call(['timew', 'tag', '@1', 'Foo', 'Tag', 'Baz', ':yes'])
+    verify(on_modify).spawn(['timew', 'untag', '@1', 'Bar', ':yes'])
+    verify(on_modify).spawn(['timew', 'tag', '@1', 'Baz', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_modify_project():
     """on-modify hook should process 'task modify' for changing project"""
 
-    when(subprocess).call(...)
+    when(on_modify).supports_retag().thenReturn(False)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -279,15 +291,16 @@ def test_hook_should_process_modify_project():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'untag', '@1', 'Foo', 'dummy', ':yes'])
-    verify(subprocess).call(['timew', 'tag', '@1', 'Foo', 'test', ':yes'])
+    verify(on_modify).spawn(['timew', 'untag', '@1', 'dummy', ':yes'])
+    verify(on_modify).spawn(['timew', 'tag', '@1', 'test', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_prepend():
     """on-modify hook should process 'task prepend'"""
 
-    when(subprocess).call(...)
+    when(on_modify).supports_retag().thenReturn(False)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -309,15 +322,15 @@ def test_hook_should_process_prepend():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'untag', '@1', 'Foo', ':yes'])
-    verify(subprocess).call(['timew', 'tag', '@1', 'Prefix Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'untag', '@1', 'Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'tag', '@1', 'Prefix Foo', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_start():
     """on-modify hook should process 'task start'"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -338,14 +351,14 @@ def test_hook_should_process_start():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'start', 'Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'start', '20190820T203842Z', 'Foo', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_stop():
     """on-modify hook should process 'task stop'"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -366,13 +379,13 @@ def test_hook_should_process_stop():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'stop', 'Foo', ':yes'])
+    verify(on_modify).spawn(['timew', 'stop', '20190820T203842Z', 'Foo', ':yes'])
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_start_issue34_with_multiple_tags():
     """on-modify hook should process 'task start' (issue #34) with multiple tags"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -395,14 +408,14 @@ def test_hook_should_process_start_issue34_with_multiple_tags():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'start', 'Foo', 'abc', 'xyz', ':yes'])
+    verify(on_modify).spawn(['timew', 'start', '20190820T203842Z', 'Foo', 'abc', 'xyz', ':yes'])
 
 
 @pytest.mark.usefixtures("teardown")
 def test_hook_should_process_start_issue34_with_single_tags():
     """on-modify hook should process 'task start' (issue #34) with single tags"""
 
-    when(subprocess).call(...)
+    when(on_modify).spawn(...)
     on_modify.main(
         json.loads(
             '''{
@@ -425,4 +438,1009 @@ def test_hook_should_process_start_issue34_with_single_tags():
             }''')
     )
 
-    verify(subprocess).call(['timew', 'start', 'Foo', 'abc', ':yes'])
+    verify(on_modify).spawn(['timew', 'start', '20190820T203842Z', 'Foo', 'abc', ':yes'])
+
+
+def read_data_dir(db_dir):
+    data_dir = db_dir / "data"
+    return {path.name: path.read_text() for path in sorted(data_dir.iterdir()) if path.name.endswith(".data")}
+
+
+def test_data_file_backend_should_start_and_stop(tmp_path):
+    """data file backend should write the same lines as 'timew start' and 'timew stop'"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path))
+
+    assert backend(['timew', 'start', '20190820T201911Z', 'Foo Bar', 'abc', ':yes']) == 0
+    assert read_data_dir(tmp_path)["2019-08.data"] == 'inc 20190820T201911Z # "Foo Bar" abc\n'
+
+    assert backend(['timew', 'stop', '20190820T203000Z', 'Foo Bar', 'abc', ':yes']) == 0
+    assert read_data_dir(tmp_path) == {
+        "2019-08.data": 'inc 20190820T201911Z - 20190820T203000Z # "Foo Bar" abc\n',
+        "tags.data": '{\n  "Foo Bar":{"count":1},\n  "abc":{"count":1}\n}',
+    }
+
+
+def test_data_file_backend_should_close_open_interval_on_start(tmp_path):
+    """data file backend should close the open interval when starting another one"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path))
+    backend(['timew', 'start', '20190831T235000Z', 'Foo', ':yes'])
+    backend(['timew', 'start', '20190901T001000Z', 'Bar', ':yes'])
+
+    data = read_data_dir(tmp_path)
+    assert data["2019-08.data"] == 'inc 20190831T235000Z - 20190901T001000Z # Foo\n'
+    assert data["2019-09.data"] == 'inc 20190901T001000Z # Bar\n'
+
+
+def test_data_file_backend_should_keep_remaining_tags_on_stop(tmp_path):
+    """data file backend should continue tracking tags which were not stopped"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path))
+    backend(['timew', 'start', '20190820T201911Z', 'Foo', 'abc', ':yes'])
+    backend(['timew', 'stop', '20190820T203000Z', 'Foo', ':yes'])
+
+    assert read_data_dir(tmp_path)["2019-08.data"] == \
+        'inc 20190820T201911Z - 20190820T203000Z # Foo abc\n' \
+        'inc 20190820T203000Z # abc\n'
+
+
+def test_data_file_backend_should_reject_stop_without_tracking(tmp_path):
+    """data file backend should fail like timew when nothing is tracked"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path))
+
+    assert backend(['timew', 'stop', 'Foo', ':yes']) == 1
+
+    backend(['timew', 'start', '20190820T201911Z', 'Foo', ':yes'])
+
+    assert backend(['timew', 'stop', 'Bar', ':yes']) == 1
+    assert read_data_dir(tmp_path)["2019-08.data"] == 'inc 20190820T201911Z # Foo\n'
+
+
+def test_data_file_backend_should_retag_and_annotate(tmp_path):
+    """data file backend should process 'tag', 'untag' and 'annotate' on @1"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path))
+    backend(['timew', 'start', '20190820T201911Z', 'Foo', 'Tag', ':yes'])
+    backend(['timew', 'untag', '@1', 'Tag', ':yes'])
+    backend(['timew', 'tag', '@1', 'Baz', ':yes'])
+    backend(['timew', 'annotate', '@1', 'Say "hi"'])
+
+    assert read_data_dir(tmp_path)["2019-08.data"] == 'inc 20190820T201911Z # Baz Foo # "Say \\"hi\\""\n'
+
+    backend(['timew', 'annotate', '@1', "''"])
+
+    assert read_data_dir(tmp_path)["2019-08.data"] == 'inc 20190820T201911Z # Baz Foo\n'
+
+
+def test_interval_should_round_trip():
+    """data file lines should be parsed and serialized without changes"""
+
+    for line in ['inc 20190820T201911Z',
+                 'inc 20190820T201911Z - 20190820T203000Z # "Foo Bar" abc',
+                 'inc 20190820T201911Z # # "Annotation"',
+                 'inc 20190820T201911Z - 20190820T203000Z # "with \\"quote\\"" x # "a # b"',
+                 'inc 20190820T201911Z # Foo # "C:\\temp\\x \\"y\\""']:
+        assert on_modify.Interval.parse(line).serialize() == line
+
+
+def test_data_files_should_modify_interval_with_backslashes(tmp_path):
+    """data file backend should keep modifying an interval whose annotation has backslashes"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path / "timewarrior"))
+
+    assert backend(['timew', 'start', '20190820T201911Z', 'Foo', ':yes']) == 0
+    assert backend(['timew', 'annotate', '@1', 'C:\\temp\\x']) == 0
+    assert backend(['timew', 'tag', '@1', 'abc', ':yes']) == 0
+    assert backend(['timew', 'stop', '20190820T203000Z', ':yes']) == 0
+    assert (tmp_path / "timewarrior" / "data" / "2019-08.data").read_text() == \
+        'inc 20190820T201911Z - 20190820T203000Z # Foo abc # "C:\\temp\\x"\n'
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_use_data_file_backend(tmp_path, monkeypatch):
+    """on-modify hook should write the data files itself if configured"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_BACKEND", "file")
+    monkeypatch.setenv("TIMEWARRIORDB", str(tmp_path))
+    when(on_modify).spawn(...)
+
+    on_modify.main(
+        {"description": "Foo", "status": "pending"},
+        {"description": "Foo", "start": "20190820T203842Z", "status": "pending"})
+
+    verify(on_modify, times=0).spawn(...)
+    assert read_data_dir(tmp_path)["tags.data"] == '{\n  "Foo":{"count":1}\n}'
+
+
+RUNNING = {"description": "Foo", "start": "20190820T203620Z", "status": "pending", "tags": ["Tag", "Bar"]}
+
+
+@pytest.mark.usefixtures("teardown")
+def test_plan_should_only_untag_removed_tags():
+    """planner should only untag what was removed from a running task"""
+
+    when(on_modify).supports_retag().thenReturn(True)
+
+    assert on_modify.plan(RUNNING, dict(RUNNING, tags=["Tag"])) == [['timew', 'untag', '@1', 'Bar', ':yes']]
+
+
+@pytest.mark.usefixtures("teardown")
+def test_plan_should_only_tag_added_tags():
+    """planner should only tag what was added to a running task"""
+
+    when(on_modify).supports_retag().thenReturn(True)
+
+    assert on_modify.plan(RUNNING, dict(RUNNING, tags=["Tag", "Bar", "Baz"])) == [['timew', 'tag', '@1', 'Baz', ':yes']]
+
+
+@pytest.mark.usefixtures("teardown")
+def test_plan_should_retag_if_supported():
+    """planner should replace tags with a single 'timew retag' if available"""
+
+    when(on_modify).supports_retag().thenReturn(True)
+
+    assert on_modify.plan(RUNNING, dict(RUNNING, tags=["Tag", "Baz"])) == \
+        [['timew', 'retag', '@1', 'Foo', 'Tag', 'Baz', ':yes']]
+
+
+def test_plan_should_ignore_reordered_tags():
+    """planner should not touch the interval if only the order of tags changed"""
+
+    assert on_modify.plan(RUNNING, dict(RUNNING, tags=["Bar", "Tag"])) == []
+
+
+def test_plan_should_skip_unchanged_annotation():
+    """planner should not annotate if the normalized annotation did not change"""
+
+    old = dict(RUNNING, annotations=[{"entry": "20190820T203620Z", "description": "Annotation"}])
+    new = dict(RUNNING, annotations=[{"entry": "20190820T203620Z", "description": "Annotation "}])
+
+    assert on_modify.plan(old, new) == []
+    assert on_modify.plan(RUNNING, dict(RUNNING, annotations=[{"entry": "20190820T203620Z", "description": "''"}])) == []
+
+
+@pytest.mark.usefixtures("teardown")
+def test_supports_retag_should_probe_timew_once(tmp_path, monkeypatch):
+    """retag support should be probed once per timew binary"""
+
+    timew = tmp_path / "timew"
+    timew.write_text("#!/bin/sh\necho 1.7.1\n")
+    timew.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path))
+    when(subprocess).check_output(...).thenReturn(b'1.7.1\n')
+
+    assert on_modify.supports_retag()
+    assert on_modify.supports_retag()
+
+    verify(subprocess, times=1).check_output([str(timew), '--version'])
+
+
+@pytest.mark.usefixtures("teardown")
+def test_drain_should_execute_in_order(state_dir):
+    """journaled commands should be executed in order and their outcome recorded"""
+
+    when(on_modify).spawn(['timew', 'stop', 'Foo', ':yes']).thenReturn(1)
+    when(on_modify).spawn(['timew', 'start', 'Bar', ':yes']).thenReturn(0)
+
+    on_modify.journal([['timew', 'stop', 'Foo', ':yes']])
+    on_modify.journal([['timew', 'start', 'Bar', ':yes']])
+    on_modify.drain()
+
+    status = json.loads((state_dir / "status.json").read_text())
+    assert status["failed"] == 1
+    assert status["commands"] == [{"cmd": ['timew', 'stop', 'Foo', ':yes'], "rc": 1},
+                                  {"cmd": ['timew', 'start', 'Bar', ':yes'], "rc": 0}]
+    assert (state_dir / "journal").read_text() == ""
+
+
+@pytest.mark.usefixtures("teardown")
+def test_drain_should_replay_unfinished_entries(state_dir):
+    """drain should replay what a crashed hook left in the journal"""
+
+    when(on_modify).spawn(...).thenReturn(0)
+    state_dir.mkdir()
+    (state_dir / "journal").write_text(
+        '{"id": "a", "cmd": ["timew", "stop", "Foo", ":yes"]}\n'
+        '{"id": "b", "cmd": ["timew", "start", "Bar", ":yes"]}\n'
+        '{"id": "a", "rc": 0}\n'
+        '{"id": "c", "cmd": ["timew", "sta')
+
+    on_modify.drain()
+
+    verify(on_modify, times=0).spawn(['timew', 'stop', 'Foo', ':yes'])
+    verify(on_modify, times=1).spawn(['timew', 'start', 'Bar', ':yes'])
+    assert (state_dir / "journal").read_text() == ""
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_journal_before_executing(state_dir, monkeypatch):
+    """on-modify hook should record commands in the journal before running timew"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_JOURNAL", "1")
+
+    def call(cmd):
+        journal = [json.loads(line) for line in (state_dir / "journal").read_text().splitlines()]
+        assert journal == [{"id": journal[0]["id"], "cmd": cmd}]
+        return 0
+
+    when(on_modify).spawn(...).thenAnswer(call)
+
+    on_modify.main(
+        {"description": "Foo", "status": "pending"},
+        {"description": "Foo", "start": "20190820T203842Z", "status": "pending"})
+
+    verify(on_modify).spawn(['timew', 'start', '20190820T203842Z', 'Foo', ':yes'])
+    assert (state_dir / "journal").read_text() == ""
+
+
+def test_hook_should_return_before_timew_when_detached(tmp_path, state_dir):
+    """on-modify hook should not wait for timew in detached mode"""
+
+    log = tmp_path / "timew.log"
+    timew = tmp_path / "timew"
+    timew.write_text("#!/bin/sh\nsleep 1\necho \"$@\" >> {}\n".format(log))
+    timew.chmod(0o755)
+
+    env = dict(os.environ, PATH="{}:{}".format(tmp_path, os.environ["PATH"]), TIMEWARRIOR_HOOK_DETACH="1",
+               TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"))
+    old = b'{"description": "Foo", "status": "pending"}\n'
+    new = b'{"description": "Foo", "start": "20190820T203842Z", "status": "pending"}\n'
+
+    started = time.time()
+    output = subprocess.run([sys.executable, on_modify.__file__], input=old + new, env=env,
+                            stdout=subprocess.PIPE, check=True).stdout
+
+    assert time.time() - started < 1
+    assert json.loads(output) == json.loads(new)
+
+    for _ in range(50):
+        if (state_dir / "status.json").exists():
+            break
+        time.sleep(0.1)
+
+    assert json.loads((state_dir / "status.json").read_text())["failed"] == 0
+    assert log.read_text() == "start 20190820T203842Z Foo :yes\n"
+
+
+def test_coalesce_should_merge_modifications_of_running_interval():
+    """coalescer should merge consecutive modifications of @1 into one of each kind"""
+
+    assert on_modify.coalesce([
+        ['timew', 'untag', '@1', 'Bar', ':yes'],
+        ['timew', 'tag', '@1', 'Baz', ':yes'],
+        ['timew', 'annotate', '@1', 'First'],
+        ['timew', 'untag', '@1', 'Baz', ':yes'],
+        ['timew', 'tag', '@1', 'Qux', 'Bar', ':yes'],
+        ['timew', 'annotate', '@1', 'Second'],
+    ]) == [
+        ['timew', 'untag', '@1', 'Baz', ':yes'],
+        ['timew', 'tag', '@1', 'Qux', 'Bar', ':yes'],
+        ['timew', 'annotate', '@1', 'Second'],
+    ]
+
+
+def test_coalesce_should_keep_last_of_repeated_stops_and_starts():
+    """coalescer should drop stops and starts which are superseded right away"""
+
+    assert on_modify.coalesce([
+        ['timew', 'stop', 'Foo', ':yes'],
+        ['timew', 'stop', 'Bar', ':yes'],
+        ['timew', 'start', 'Foo', ':yes'],
+        ['timew', 'tag', '@1', 'Tag', ':yes'],
+        ['timew', 'start', 'Bar', ':yes'],
+        ['timew', 'annotate', '@1', 'Annotation'],
+        ['timew', 'stop', 'Qux', ':yes'],
+        ['timew', 'untag', '@1', 'Bar', ':yes'],
+        ['timew', 'stop', 'Baz', ':yes'],
+        ['timew', 'stop', 'Baz', ':yes'],
+        ['timew', 'stop', ':yes'],
+        ['timew', 'stop', 'Qux', ':yes'],
+    ]) == [
+        ['timew', 'stop', 'Foo', ':yes'],
+        ['timew', 'stop', 'Bar', ':yes'],
+        ['timew', 'start', 'Bar', ':yes'],
+        ['timew', 'annotate', '@1', 'Annotation'],
+        ['timew', 'stop', 'Qux', ':yes'],
+        ['timew', 'untag', '@1', 'Bar', ':yes'],
+        ['timew', 'stop', 'Baz', ':yes'],
+        ['timew', 'stop', ':yes'],
+    ]
+
+
+def test_coalesce_should_cancel_start_stop_pairs():
+    """coalescer should cancel a task stopped and started again, or started and stopped again"""
+
+    assert on_modify.coalesce([
+        ['timew', 'stop', '20190820T203842Z', 'Foo', ':yes'],
+        ['timew', 'start', '20190820T203843Z', 'Foo', ':yes'],
+        ['timew', 'annotate', '@1', 'Annotation'],
+        ['timew', 'start', '20190820T203850Z', 'Bar', ':yes'],
+        ['timew', 'tag', '@1', 'Tag', ':yes'],
+        ['timew', 'stop', '20190820T203851Z', 'Bar', ':yes'],
+        ['timew', 'start', '20190820T203900Z', 'Baz', ':yes'],
+        ['timew', 'stop', '20190820T203910Z', 'Baz', 'Tag', ':yes'],
+        ['timew', 'stop', '20190820T203911Z', 'Qux', ':yes'],
+    ], 5) == [
+        ['timew', 'annotate', '@1', 'Annotation'],
+        ['timew', 'stop', '20190820T203850Z', ':yes'],
+        ['timew', 'start', '20190820T203900Z', 'Baz', ':yes'],
+        ['timew', 'stop', '20190820T203910Z', 'Baz', 'Tag', ':yes'],
+        ['timew', 'stop', '20190820T203911Z', 'Qux', ':yes'],
+    ]
+
+
+def test_coalesce_should_keep_start_stop_pairs_apart():
+    """coalescer should keep the gap or session between a stop and start, or start and stop, further apart"""
+
+    pairs = [
+        ['timew', 'stop', '20190820T100000Z', 'Foo', ':yes'],
+        ['timew', 'start', '20190820T102500Z', 'Foo', ':yes'],
+        ['timew', 'stop', '20190820T105000Z', 'Foo', ':yes'],
+    ]
+
+    assert on_modify.coalesce(pairs, 60) == pairs
+    assert on_modify.coalesce([['timew', 'stop', 'Foo', ':yes'], ['timew', 'start', 'Foo', ':yes']], 60) == [
+        ['timew', 'stop', 'Foo', ':yes'], ['timew', 'start', 'Foo', ':yes']]
+
+
+def run_hooks(tmp_path, transitions, window, linger=0, debounce=0):
+    log = tmp_path / "timew.log"
+    timew = tmp_path / "timew"
+    timew.write_text("#!/bin/sh\necho \"$@\" >> {}\n".format(log))
+    timew.chmod(0o755)
+
+    env = dict(os.environ, PATH="{}:{}".format(tmp_path, os.environ["PATH"]), TIMEWARRIOR_HOOK_BATCH=str(window),
+               TIMEWARRIOR_HOOK_DEBOUNCE=str(debounce), TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"))
+    hook = "{} {}".format(sys.executable, on_modify.__file__)
+    script = "".join("printf '%s\\n%s\\n' '{}' '{}' | {} >/dev/null\n".format(json.dumps(old), json.dumps(new), hook)
+                     for old, new in transitions)
+    script += "sleep {}\ncat {} > {}.seen 2>/dev/null || true\n".format(linger, log, log)
+    subprocess.run(["sh", "-c", script], env=env, check=True)
+
+    return log
+
+
+def wait_for_flush(state_dir, timeout):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if (state_dir / "status.json").exists() and not (state_dir / "batch.pid").exists():
+            return True
+        time.sleep(0.05)
+
+    return False
+
+
+def test_hook_should_batch_bulk_modifications(tmp_path, state_dir):
+    """on-modify hook should execute the net effect of a bulk command once"""
+
+    transitions = [(dict(RUNNING, annotations=[{"entry": "20190820T203620Z", "description": "A{}".format(n)}]),
+                    dict(RUNNING, annotations=[{"entry": "20190820T203620Z", "description": "A{}".format(n + 1)}]))
+                   for n in range(5)]
+
+    run_hooks(tmp_path, transitions, 0.5, linger=2)
+
+    # Flushed by the timer while the task process was still running.
+    assert (tmp_path / "timew.log.seen").read_text() == "annotate @1 A5\n"
+
+
+def test_hook_should_flush_batch_when_task_exits(tmp_path, state_dir):
+    """on-modify hook should flush a batch as soon as the task process has exited"""
+
+    transitions = [({"description": "Foo", "status": "pending"},
+                    {"description": "Foo", "start": "20190820T203842Z", "status": "pending"})]
+
+    started = time.time()
+    log = run_hooks(tmp_path, transitions, 30)
+
+    assert wait_for_flush(state_dir, 5)
+    assert time.time() - started < 5
+    assert log.read_text() == "start 20190820T203842Z Foo :yes\n"
+
+
+def test_hook_should_pass_task_through_unchanged(tmp_path, state_dir):
+    """on-modify hook should return the modified task byte for byte"""
+
+    old = b'{"description":"Foo","status":"pending","uuid":"02bc8839-b304-49f9-ac1a-29ac4850583f"}\n'
+    new = b'{"description":"Gr\xc3\xbc\xc3\x9fe \\"Foo\\" \xe2\x9c\x93 ' + b'x' * 100000 + b'",' \
+          b'"annotations":[{"entry":"20190820T203842Z","description":"\xff invalid UTF-8"}],' \
+          b'"status":"pending","uuid":"02bc8839-b304-49f9-ac1a-29ac4850583f"}\n'
+    env = dict(os.environ, TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"))
+
+    output = subprocess.run([sys.executable, on_modify.__file__], input=old + new, env=env,
+                            stdout=subprocess.PIPE, check=True).stdout
+
+    assert output == new
+
+
+def test_parse_task_should_extract_needed_fields():
+    """task parser should extract the fields the hook needs"""
+
+    text = '{"description":"Foo \\"start\\": x","annotations":[{"entry":"20190820T203842Z","description":"First"},' \
+           '{"entry":"20190820T203843Z","description":"Second"}],"entry":"20190820T203842Z","project":"dummy",' \
+           '"start": "20190820T203842Z","tags":["abc","xyz"],"uda":"' + "x" * 5000 + '"}'
+
+    assert on_modify.parse_task(text) == {
+        "annotations": [{"entry": "20190820T203842Z", "description": "First"}],
+        "description": 'Foo "start": x',
+        "project": "dummy",
+        "start": "20190820T203842Z",
+        "tags": ["abc", "xyz"],
+    }
+
+
+def test_parse_task_should_not_mistake_annotation_for_description():
+    """task parser should not take the description of an annotation for the one of the task"""
+
+    text = '{{"annotations":[{{"entry":"20190820T203842Z","description":"Annotation"}}],"description":"Foo",' \
+           '"uda":"{}"}}'.format("x" * 5000)
+
+    assert on_modify.parse_task(text)["description"] == "Foo"
+    assert on_modify.extract_annotation_from(on_modify.parse_task(text)) == "Annotation"
+
+
+def test_parse_task_should_ignore_keys_in_strings():
+    """task parser should not find keys inside of strings"""
+
+    text = '{{"description":"\\"start\\": \\"yes\\"","status":"pending","uda":"{}"}}'.format("x" * 5000)
+
+    assert on_modify.find_value(text, "start") == -1
+    assert on_modify.parse_task(text) == {"description": '"start": "yes"'}
+
+
+def test_parse_task_should_reject_malformed_input():
+    """task parser should fail on malformed input like json.loads"""
+
+    with pytest.raises(ValueError):
+        on_modify.parse_task('{{"description":"Foo","uda":"{}","start":}}'.format("x" * 5000))
+
+
+def fake_timew(tmp_path, script):
+    timew = tmp_path / "bin" / "timew"
+    timew.parent.mkdir(exist_ok=True)
+    timew.write_text("#!/bin/sh\n" + script)
+    timew.chmod(0o755)
+    return timew
+
+
+def test_resolve_timew_should_cache_location(tmp_path, state_dir, monkeypatch):
+    """timew location should be looked up once per PATH and binary"""
+
+    timew = fake_timew(tmp_path, "exit 0\n")
+    monkeypatch.setenv("PATH", "{}:/usr/bin:/bin".format(timew.parent))
+
+    assert on_modify.resolve_timew() == str(timew)
+    assert json.loads((state_dir / "timew.json").read_text())["path"] == str(timew)
+
+    when(shutil).which(...).thenReturn(None)
+    try:
+        assert on_modify.resolve_timew() == str(timew)
+
+        monkeypatch.setenv("PATH", "/usr/bin:/bin")
+        assert on_modify.resolve_timew() is None
+    finally:
+        unstub()
+
+
+def test_spawn_should_return_exit_code_and_limit_environment(tmp_path, monkeypatch):
+    """launcher should run timew with a minimal environment and return its exit code"""
+
+    output = tmp_path / "output"
+    timew = fake_timew(tmp_path, 'echo "$@|$TIMEWARRIORDB|$SECRET" > {}\nexit 3\n'.format(output))
+    monkeypatch.setenv("PATH", "{}:/usr/bin:/bin".format(timew.parent))
+    monkeypatch.setenv("TIMEWARRIORDB", "/tmp/timew")
+    monkeypatch.setenv("SECRET", "hidden")
+
+    assert on_modify.spawn(['timew', 'start', 'Foo Bar', ':yes']) == 3
+    assert output.read_text() == "start Foo Bar :yes|/tmp/timew|\n"
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_skip_commands_without_effect(tmp_path):
+    """on-modify hook should not run timew if the latest interval already matches"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path / "timewarrior"))
+    backend(['timew', 'start', '20190820T203620Z', 'Foo', 'Tag', 'Bar', ':yes'])
+    backend(['timew', 'annotate', '@1', 'Annotation'])
+    when(on_modify).spawn(...).thenReturn(0)
+    when(on_modify).supports_retag().thenReturn(False)
+
+    assert on_modify.execute(['timew', 'tag', '@1', 'Tag', ':yes']) == 0
+    assert on_modify.execute(['timew', 'untag', '@1', 'Baz', ':yes']) == 0
+    assert on_modify.execute(['timew', 'annotate', '@1', 'Annotation']) == 0
+    assert on_modify.execute(['timew', 'stop', 'Foo', 'Qux', ':yes']) == 0
+    verify(on_modify, times=0).spawn(...)
+
+    on_modify.execute(['timew', 'untag', '@1', 'Bar', ':yes'])
+    verify(on_modify, times=1).spawn(...)
+
+    backend(['timew', 'stop', '20190820T210000Z', ':yes'])
+
+    assert on_modify.execute(['timew', 'stop', 'Foo', ':yes']) == 0
+    verify(on_modify, times=1).spawn(...)
+
+
+def test_tracked_interval_should_follow_data_files(tmp_path, state_dir):
+    """interval cache should be rebuilt whenever the data files change"""
+
+    backend = on_modify.DataFileBackend(str(tmp_path / "timewarrior"))
+
+    assert on_modify.tracked_interval() == (False, None)
+
+    backend(['timew', 'start', '20190831T235000Z', 'Foo', ':yes'])
+    known, interval = on_modify.tracked_interval()
+    assert known and interval.serialize() == 'inc 20190831T235000Z # Foo'
+    assert json.loads((state_dir / "interval.json").read_text())["interval"]["tags"] == ["Foo"]
+
+    (tmp_path / "timewarrior" / "data" / "2019-09.data").write_text("")
+    backend(['timew', 'tag', '@1', 'Bar', ':yes'])
+    known, interval = on_modify.tracked_interval()
+    assert known and interval.serialize() == 'inc 20190831T235000Z # Bar Foo'
+
+
+UUID = "6cab88f0-ac12-4a87-995a-0e7d39810c05"
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_address_interval_by_uuid(tmp_path, state_dir, monkeypatch):
+    """on-modify hook should address the interval of a running task through the UUID index"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_UUID_INDEX", "1")
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_INTERVAL_CACHE", "0")
+    when(on_modify).supports_retag().thenReturn(False)
+    when(on_modify).spawn(...).thenReturn(0)
+    backend = on_modify.DataFileBackend(str(tmp_path / "timewarrior"))
+    stopped = dict(RUNNING, uuid=UUID)
+    del stopped["start"]
+    running = dict(RUNNING, uuid=UUID, start="20190831T235000Z")
+
+    on_modify.main(stopped, running)
+    verify(on_modify).spawn(['timew', 'start', '20190831T235000Z', 'Foo', 'Tag', 'Bar', ':yes'])
+    assert json.loads((state_dir / "index.json").read_text()) == {UUID: "20190831T235000Z"}
+
+    backend(['timew', 'start', '20190831T235000Z', 'Foo', 'Tag', 'Bar', ':yes'])
+    backend(['timew', 'start', '20190901T001000Z', 'Other', ':yes'])
+    backend(['timew', 'start', '20190901T002000Z', 'Another', ':yes'])
+
+    on_modify.main(running, dict(running, tags=["Tag"]))
+    verify(on_modify).spawn(['timew', 'untag', '@3', 'Bar', ':yes'])
+
+    on_modify.main(running, stopped)
+    assert json.loads((state_dir / "index.json").read_text()) == {}
+
+
+@pytest.mark.usefixtures("teardown")
+def test_data_files_should_address_interval_by_start(tmp_path, state_dir, monkeypatch):
+    """data file backend should address the interval of a running task by its start time"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_UUID_INDEX", "yes")
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_BACKEND", "file")
+    stopped = dict(RUNNING, uuid=UUID)
+    del stopped["start"]
+    running = dict(RUNNING, uuid=UUID, start="20190831T235000Z")
+    other = {"description": "Other", "status": "pending", "uuid": "e1c4b8d4-5f1f-4b8e-9b44-6ee4a0b1d1f2"}
+
+    on_modify.main(stopped, running)
+    on_modify.main(other, dict(other, start="20190901T001000Z"))
+    on_modify.main(running, dict(running, tags=["Tag"]))
+
+    assert on_modify.interval_id(UUID) == "@20190831T235000Z"
+    assert (tmp_path / "timewarrior" / "data" / "2019-08.data").read_text() == \
+        "inc 20190831T235000Z - 20190901T001000Z # Foo Tag\n"
+    assert on_modify.load_state("failures.json") is None
+
+
+def test_interval_id_should_fall_back_to_latest_interval(state_dir):
+    """UUID index should address @1 for tasks it does not know"""
+
+    assert on_modify.interval_id(UUID) == '@1'
+    assert on_modify.resolve_addresses(['timew', 'tag', '@' + UUID, 'Foo']) == ['timew', 'tag', '@1', 'Foo']
+
+
+def test_config_should_read_taskrc_and_environment(tmp_path, monkeypatch):
+    """configuration should come from .taskrc, its includes and the environment"""
+
+    (tmp_path / "hook.rc").write_text("timewarrior.hook.journal=yes\ntimewarrior.hook.backend=file\n")
+    (tmp_path / "taskrc").write_text("data.location=~/.task\n# timewarrior.hook.detach=yes\ninclude hook.rc\n")
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_BACKEND", "timew")
+
+    assert on_modify.enabled("journal")
+    assert not on_modify.enabled("detach")
+    assert on_modify.setting("backend") == "timew"
+
+
+def test_config_should_report_invalidating_source(tmp_path, state_dir, monkeypatch):
+    """configuration snapshot should be rebuilt, and say why, only if a source changed"""
+
+    taskrc = tmp_path / "taskrc"
+    taskrc.write_text("timewarrior.hook.batch=2\n")
+    os.utime(str(taskrc), (time.time() - 10, time.time() - 10))
+
+    snapshot = on_modify.config()
+
+    assert snapshot["settings"]["batch"] == "2"
+    assert snapshot["reason"] == "no snapshot"
+
+    on_modify.loaded_config.clear()
+    when(on_modify).build_config(...).thenRaise(AssertionError("snapshot should be reused"))
+    try:
+        assert on_modify.setting("batch") == "2"
+    finally:
+        unstub()
+
+    taskrc.write_text("timewarrior.hook.batch=5\n")
+    os.utime(str(taskrc), (time.time() - 5, time.time() - 5))
+    on_modify.loaded_config.clear()
+    snapshot = on_modify.config()
+
+    assert snapshot["settings"]["batch"] == "5"
+    assert snapshot["reason"] == str(taskrc)
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_BATCH", "1")
+    on_modify.loaded_config.clear()
+    snapshot = on_modify.config()
+
+    assert snapshot["settings"]["batch"] == "1"
+    assert snapshot["reason"] == "environment"
+
+
+def test_config_should_be_validated_once_per_process(tmp_path):
+    """configuration sources should be stat'ed once, however often settings are read"""
+
+    (tmp_path / "taskrc").write_text("timewarrior.hook.batch=2\n")
+    os.utime(str(tmp_path / "taskrc"), (time.time() - 10, time.time() - 10))
+    on_modify.config()
+    on_modify.loaded_config.clear()
+    stats = []
+    stat_key = on_modify.stat_key
+    when(on_modify).stat_key(...).thenAnswer(lambda path: stats.append(path) or stat_key(path))
+
+    for name in on_modify.SETTINGS:
+        on_modify.setting(name)
+
+    on_modify.compiled_rules()
+
+    assert sorted(stats) == sorted([str(tmp_path / "taskrc"), on_modify.timew_config_path()])
+
+
+def test_config_should_not_use_data_files_with_exclusions(tmp_path, monkeypatch):
+    """data file backend should not be used if Timewarrior has to apply exclusions"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_BACKEND", "file")
+    (tmp_path / "timewarrior").mkdir()
+    (tmp_path / "timewarrior" / "timewarrior.cfg").write_text("verbose = yes\n")
+
+    assert on_modify.use_data_files()
+
+    (tmp_path / "timewarrior" / "timewarrior.cfg").write_text("define exclusions:\n  monday = <8:00 >18:00\n")
+    on_modify.loaded_config.clear()
+
+    assert not on_modify.use_data_files()
+    assert on_modify.config()["timew"] == {"exclusions.monday": "<8:00 >18:00"}
+
+
+@pytest.mark.usefixtures("teardown")
+def test_rules_should_filter_tracked_tasks(tmp_path):
+    """tracking rules should include projects by prefix and exclude tags and UDA values"""
+
+    (tmp_path / "taskrc").write_text(
+        "timewarrior.hook.include.project=work,home.garden\n"
+        "timewarrior.hook.exclude.tag=private\n"
+        "timewarrior.hook.exclude.uda.billable=no,0\n")
+
+    assert on_modify.tracked({"description": "Foo", "project": "work"})
+    assert on_modify.tracked({"description": "Foo", "project": "work.acme"})
+    assert on_modify.tracked({"description": "Foo", "project": "home.garden", "billable": "yes"})
+    assert not on_modify.tracked({"description": "Foo", "project": "workshop"})
+    assert not on_modify.tracked({"description": "Foo", "project": "home"})
+    assert not on_modify.tracked({"description": "Foo"})
+    assert not on_modify.tracked({"description": "Foo", "project": "work", "tags": "abc,private"})
+    assert not on_modify.tracked({"description": "Foo", "project": "work", "billable": 0})
+    assert "billable" in on_modify.task_fields()
+
+    when(on_modify).spawn(...)
+    on_modify.main({"description": "Foo", "project": "work", "tags": ["private"]},
+                   {"description": "Foo", "project": "work", "tags": ["private"], "start": "20190820T203842Z"})
+    on_modify.main({"description": "Foo", "project": "home", "start": "20190820T203842Z"},
+                   {"description": "Foo", "project": "home", "start": "20190820T203842Z", "end": "20190820T213842Z"})
+
+    verify(on_modify, times=0).spawn(...)
+
+
+def test_rules_should_map_udas_and_project_hierarchy_to_tags(tmp_path):
+    """tags should include the levels of the project and configured UDA values"""
+
+    (tmp_path / "taskrc").write_text("timewarrior.hook.project_split=yes\ntimewarrior.hook.uda_tags=client,estimate\n")
+
+    task = {"description": "Foo", "project": "work.acme.web", "tags": ["abc"], "client": "ACME", "estimate": 3.0}
+
+    assert on_modify.extract_tags_from(task) == ["Foo", "work", "work.acme", "work.acme.web", "abc", "ACME", "3"]
+    assert on_modify.task_fields()[-2:] == ("client", "estimate")
+
+
+def test_hook_should_not_spawn_for_excluded_task(tmp_path):
+    """on-modify hook should only echo a task excluded by the rules"""
+
+    (tmp_path / "taskrc").write_text("timewarrior.hook.exclude.project=home\n")
+    old = b'{"description":"Foo","project":"home.garden","status":"pending"}\n'
+    new = b'{"description":"Foo","project":"home.garden","start":"20190820T203842Z","status":"pending"}\n'
+    env = dict(os.environ, PATH=str(tmp_path), TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"))
+
+    output = subprocess.run([sys.executable, on_modify.__file__], input=old + new, env=env,
+                            stdout=subprocess.PIPE, check=True).stdout
+
+    assert output == new
+
+
+def test_hook_should_debounce_start_stop_toggles(tmp_path, state_dir):
+    """on-modify hook should cancel a start and stop in quick succession and keep the times of the others"""
+
+    foo = {"description": "Foo", "status": "pending"}
+    bar = {"description": "Bar", "status": "pending"}
+    transitions = [(foo, dict(foo, start="20190820T203842Z")),
+                   (dict(foo, start="20190820T203842Z"), dict(foo, modified="20190820T203843Z")),
+                   (bar, dict(bar, start="20190820T203850Z"))]
+
+    log = run_hooks(tmp_path, transitions, 0, debounce=1)
+
+    assert not log.exists()
+    assert wait_for_flush(state_dir, 5)
+    assert log.read_text() == "stop 20190820T203842Z :yes\nstart 20190820T203850Z Bar :yes\n"
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_skip_replayed_modifications(monkeypatch):
+    """on-modify hook should not repeat the commands of a modification it has processed already"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_LEDGER", "yes")
+    old = {"description": "Foo", "modified": "20190820T203842Z", "status": "pending", "uuid": UUID}
+    new = dict(old, modified="20190820T203850Z", start="20190820T203850Z")
+
+    when(on_modify).spawn(...)
+    on_modify.main(old, new)
+    on_modify.main(old, new)
+    on_modify.main(new, dict(new, modified="20190820T203851Z", tags=["abc"]))
+
+    verify(on_modify, times=1).spawn(['timew', 'start', '20190820T203850Z', 'Foo', ':yes'])
+    verify(on_modify, times=1).spawn(['timew', 'tag', '@1', 'abc', ':yes'])
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_follow_toggles_within_a_second(monkeypatch):
+    """on-modify hook should not take a task started again within the same second for a replay"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_LEDGER", "yes")
+    stopped = {"description": "Foo", "modified": "20190820T203850Z", "status": "pending", "uuid": UUID}
+    running = dict(stopped, start="20190820T203850Z")
+
+    when(on_modify).spawn(...)
+    on_modify.main(stopped, running)
+    on_modify.main(running, stopped)
+    on_modify.main(stopped, running)
+
+    verify(on_modify, times=2).spawn(['timew', 'start', '20190820T203850Z', 'Foo', ':yes'])
+
+
+def test_ledger_should_evict_oldest_entries(monkeypatch):
+    """ledger should forget entries beyond its size and age"""
+
+    monkeypatch.setattr(on_modify, "LEDGER_SIZE", 2)
+    tasks = [{"modified": "20190820T203842Z", "uuid": "{}-0000-4000-8000-000000000000".format(n)} for n in range(3)]
+
+    assert not any(on_modify.seen_before(task, [["timew", "stop", ":yes"]]) for task in tasks)
+    assert on_modify.seen_before(tasks[2], [["timew", "stop", ":yes"]])
+    assert not on_modify.seen_before(tasks[0], [["timew", "stop", ":yes"]])
+
+    monkeypatch.setattr(on_modify, "LEDGER_AGE", -1)
+
+    assert not on_modify.seen_before(tasks[0], [["timew", "stop", ":yes"]])
+
+
+def test_spawn_should_kill_timew_at_deadline(tmp_path, monkeypatch):
+    """launcher should kill a timew still running at the deadline"""
+
+    timew = fake_timew(tmp_path, 'sleep 5\n')
+    monkeypatch.setenv("PATH", "{}:/usr/bin:/bin".format(timew.parent))
+    monkeypatch.setitem(on_modify.limits, "deadline", time.time() + 0.2)
+
+    started = time.time()
+
+    assert on_modify.spawn(['timew', 'stop', ':yes']) == on_modify.TIMED_OUT
+    assert time.time() - started < 2
+
+
+def test_hand_off_should_start_one_retry_process_at_a_time(tmp_path, state_dir, monkeypatch):
+    """commands which timed out should be retried by a single background process"""
+
+    monkeypatch.setattr(on_modify, "__file__", str(fake_timew(tmp_path, "sleep 5\n")))
+    monkeypatch.setattr(on_modify.sys, "executable", "/bin/sh")
+
+    on_modify.hand_off()
+    retrying = on_modify.load_state("retry.pid")
+    on_modify.hand_off()
+
+    try:
+        assert on_modify.pid_alive(retrying)
+        assert on_modify.load_state("retry.pid") == retrying
+    finally:
+        os.kill(retrying, 9)
+
+
+@pytest.mark.usefixtures("teardown")
+def test_hook_should_queue_commands_which_timed_out(state_dir, monkeypatch):
+    """on-modify hook should leave a command which timed out, and those after it, to be retried"""
+
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_TIMEOUT", "0.5")
+    when(on_modify).spawn(['timew', 'untag', '@1', 'abc', ':yes']).thenReturn(on_modify.TIMED_OUT)
+    when(on_modify).hand_off()
+    when(on_modify).supports_retag().thenReturn(False)
+
+    on_modify.main(dict(RUNNING, tags=["abc"]), dict(RUNNING, tags=["xyz"], annotations=[
+        {"entry": "20190820T203620Z", "description": "Annotation"}]))
+
+    verify(on_modify, times=1).spawn(...)
+    verify(on_modify, times=1).hand_off()
+    assert on_modify.limits["deadline"] is None
+    assert [cmd for entry_id, cmd in on_modify.pending_commands(open(str(state_dir / "journal"), "rb"))] == [
+        ['timew', 'untag', '@1', 'abc', ':yes'],
+        ['timew', 'tag', '@1', 'xyz', ':yes'],
+        ['timew', 'annotate', '@1', 'Annotation'],
+    ]
+
+    # Later modifications queue up behind them.
+    when(on_modify).spawn(...).thenReturn(0)
+    when(on_modify).spawn(['timew', 'tag', '@1', 'xyz', ':yes']).thenReturn(1)
+    on_modify.main(RUNNING, dict(RUNNING, end="20190820T210000Z"))
+
+    assert (state_dir / "journal").read_text() == ""
+    assert json.loads((state_dir / "failures.json").read_text())[0]["rc"] == 1
+    assert [result["cmd"][1] for result in json.loads((state_dir / "status.json").read_text())["commands"]] == [
+        'untag', 'tag', 'annotate', 'stop']
+
+
+@pytest.mark.usefixtures("teardown")
+def test_drain_should_stop_at_command_which_timed_out(state_dir):
+    """drain should keep a command which timed out in the journal, together with all after it"""
+
+    when(on_modify).spawn(['timew', 'stop', 'Foo', ':yes']).thenReturn(0)
+    when(on_modify).spawn(['timew', 'start', 'Bar', ':yes']).thenReturn(on_modify.TIMED_OUT)
+
+    on_modify.journal([['timew', 'stop', 'Foo', ':yes'], ['timew', 'start', 'Bar', ':yes'],
+                       ['timew', 'annotate', '@1', 'Baz']])
+
+    assert not on_modify.drain(timeout=1)
+    assert on_modify.limits["deadline"] is None
+    assert [cmd for entry_id, cmd in on_modify.pending_commands(open(str(state_dir / "journal"), "rb"))] == [
+        ['timew', 'start', 'Bar', ':yes'],
+        ['timew', 'annotate', '@1', 'Baz'],
+    ]
+    verify(on_modify, times=0).spawn(['timew', 'annotate', '@1', 'Baz'])
+
+
+def test_hook_should_serialize_concurrent_invocations(tmp_path, state_dir):
+    """concurrent hook invocations should take turns, lose no update and not wait unduly"""
+
+    env = dict(os.environ, TIMEWARRIOR_HOOK_BACKEND="file", TIMEWARRIOR_HOOK_UUID_INDEX="yes",
+               TIMEWARRIOR_HOOK_DEBUG="yes", TIMEWARRIOR_HOOK_SOCKET=str(tmp_path / "no.sock"))
+    uuids = ["{:08d}-0000-4000-8000-000000000000".format(n) for n in range(16)]
+    hooks = []
+
+    for n, uuid in enumerate(uuids):
+        old = {"description": "Task {}".format(n), "status": "pending", "uuid": uuid}
+        new = dict(old, start="20190820T20{:02d}00Z".format(n))
+        hook = subprocess.Popen([sys.executable, on_modify.__file__], env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        hook.stdin.write("{}\n{}\n".format(json.dumps(old), json.dumps(new)).encode("utf-8"))
+        hook.stdin.close()
+        hooks.append(hook)
+
+    waits = []
+
+    for hook in hooks:
+        stderr = hook.stderr.read().decode("utf-8")
+        assert hook.wait(timeout=30) == 0, stderr
+        waits.extend(float(wait) for wait in re.findall(r"waited ([0-9.]+)s for the lock", stderr))
+
+    assert sorted(json.loads((state_dir / "index.json").read_text())) == uuids
+    assert len((tmp_path / "timewarrior" / "data" / "2019-08.data").read_text().splitlines()) == len(uuids)
+    assert len(waits) == len(uuids)
+    assert max(waits) < 10
+    assert (state_dir / "hook.queue").read_text() == ""
+
+
+def test_process_batch_should_match_sequence_of_main_calls(tmp_path, monkeypatch):
+    """batch processing should leave the same intervals behind as processing each modification"""
+
+    foo = {"description": "Foo", "status": "pending", "tags": ["abc"], "uuid": UUID}
+    bar = {"description": "Bar", "status": "pending", "uuid": "0b6e0c4e-8c36-4d0d-8c4f-4b1f1c1b3c1d"}
+    running = dict(RUNNING, uuid="7d1e5a34-22ee-4a5e-9d3c-1b0f6c9a2f11")
+    stopped = dict((key, value) for key, value in running.items() if key != "start")
+    chain = [
+        (running, dict(running, tags=["Tag", "Baz"])),
+        (dict(running, tags=["Tag", "Baz"]), dict(stopped, tags=["Tag", "Baz"], modified="20190820T203700Z")),
+        (foo, dict(foo, start="20190820T203800Z")),
+        (dict(foo, start="20190820T203800Z"), dict(foo, start="20190820T203800Z", tags=["abc", "xyz"])),
+        (dict(foo, start="20190820T203800Z", tags=["abc", "xyz"]),
+         dict(foo, start="20190820T203800Z", tags=["abc", "xyz"], annotations=[
+             {"entry": "20190820T203900Z", "description": "Annotation"}])),
+        (dict(foo, start="20190820T203800Z", tags=["abc", "xyz"], annotations=[
+            {"entry": "20190820T203900Z", "description": "Annotation"}]),
+         dict(foo, tags=["abc", "xyz"], annotations=[{"entry": "20190820T203900Z", "description": "Annotation"}],
+              modified="20190820T204000Z")),
+        (bar, dict(bar, start="20190820T204100Z")),
+        (dict(bar, start="20190820T204100Z"), dict(bar, start="20190820T204100Z", project="work")),
+    ]
+    monkeypatch.setenv("TIMEWARRIOR_HOOK_BACKEND", "file")
+
+    def data(name, process, open_tags=("Foo", "Tag", "Bar"), open_start="20190820T203620Z"):
+        monkeypatch.setenv("TIMEWARRIORDB", str(tmp_path / name))
+        backend = on_modify.DataFileBackend(str(tmp_path / name))
+        backend(['timew', 'start', open_start] + list(open_tags) + [':yes'])
+        process()
+        return (tmp_path / name / "data" / "2019-08.data").read_text()
+
+    def one_by_one():
+        for old, new in chain:
+            on_modify.main(old, new)
+
+    commands = []
+    expected = data("sequence", one_by_one)
+
+    assert data("batch", lambda: commands.extend(on_modify.process_batch(chain))) == expected
+    assert expected == (
+        "inc 20190820T203620Z - 20190820T203700Z # Baz Foo Tag\n"
+        "inc 20190820T203800Z - 20190820T204000Z # Foo abc xyz # \"Annotation\"\n"
+        "inc 20190820T204100Z # Bar work\n")
+    assert commands == [
+        ['timew', 'retag', '@1', 'Foo', 'Tag', 'Baz', ':yes'],
+        ['timew', 'stop', '20190820T203700Z', 'Foo', 'Tag', 'Baz', ':yes'],
+        ['timew', 'start', '20190820T203800Z', 'Foo', 'abc', 'xyz', ':yes'],
+        ['timew', 'annotate', '@1', 'Annotation'],
+        ['timew', 'stop', '20190820T204000Z', ':yes'],
+        ['timew', 'start', '20190820T204100Z', 'Bar', 'work', ':yes'],
+    ]
+
+    # An open interval which is not part of any chain is stopped when Foo is started.
+    chain = chain[2:6]
+    expected = data("other-sequence", one_by_one, ["Other"], "20190820T090000Z")
+
+    assert data("other-batch", lambda: on_modify.process_batch(chain), ["Other"], "20190820T090000Z") == expected
+    assert expected == (
+        "inc 20190820T090000Z - 20190820T203800Z # Other\n"
+        "inc 20190820T203800Z - 20190820T204000Z # Foo abc xyz # \"Annotation\"\n")
+
+
+def test_classify_should_tell_transitions_apart():
+    """classifier should tell starts, stops and modifications of running tasks apart"""
+
+    started = dict(RUNNING, start="20190820T203620Z")
+    stopped = dict((key, value) for key, value in RUNNING.items() if key != "start")
+    annotated = dict(RUNNING, annotations=[{"entry": "20190820T203620Z", "description": "Annotation"}])
+    Transition = on_modify.Transition
+
+    assert on_modify.classify(stopped, started) == Transition.START
+    assert on_modify.classify(started, stopped) == Transition.STOP
+    assert on_modify.classify(started, dict(started, end="20190820T203700Z")) == Transition.STOP
+    assert on_modify.classify(started, started) == Transition.NOOP
+    assert on_modify.classify(stopped, dict(stopped, tags=["Foo"])) == Transition.NOOP
+    assert on_modify.classify(started, dict(started, tags=["Bar", "Tag"])) == Transition.NOOP
+    assert on_modify.classify(started, dict(started, tags=["Baz"])) == Transition.RETAG
+    assert on_modify.classify(started, annotated) == Transition.REANNOTATE
+    assert on_modify.classify(started, dict(annotated, project="work")) == Transition.RETAG | Transition.REANNOTATE
+
+
+def test_classify_columns_should_agree_with_truth_table():
+    """batch classifier should return the transition of each row of its columns"""
+
+    rows = [[code >> bit & 1 for bit in range(6)] for code in range(64)] * 3
+    columns = [bytes(row[bit] for row in rows) for bit in range(6)]
+
+    result = on_modify.classify_columns(*columns)
+
+    assert [on_modify.Transition(value) for value in result] == [on_modify.transition_of(*row) for row in rows]
+    assert on_modify.classify_columns(b'', b'', b'', b'', b'', b'') == b''
+
+    with pytest.raises(ValueError):
+        on_modify.classify_columns(b'\x01', b'', b'', b'', b'', b'')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Copyright 2026, Gothenburg Bit Factory
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# https://www.opensource.org/licenses/mit-license.php
+#
+###############################################################################
+import json
+
+import pytest
+from mockito import verify, when
+
+import on_modify
+import reconcile
+
+FOO = {
+    "description": "Foo",
+    "entry": "20190820T195911Z",
+    "modified": "20190820T200000Z",
+    "start": "20190820T200000Z",
+    "status": "pending",
+    "tags": ["abc"],
+    "uuid": "25b66283-96e0-42b4-b835-8efd0ea1043c",
+}
+
+BAR = {
+    "description": "Bar",
+    "entry": "20190820T195911Z",
+    "modified": "20190820T195911Z",
+    "project": "work",
+    "status": "pending",
+    "uuid": "13f83e99-f6a2-4857-9e00-bdeede064772",
+}
+
+
+pytestmark = pytest.mark.usefixtures("state_dir")
+
+
+def test_iter_json_should_decode_export_across_chunks():
+    """Exports should be decoded object by object, however they are split when read"""
+
+    text = json.dumps([FOO, BAR], indent=2)
+    chunks = [text[position:position + 7] for position in range(0, len(text), 7)]
+
+    assert list(reconcile.iter_json(chunks)) == [FOO, BAR]
+    assert list(reconcile.iter_json(["[\n", "]\n"])) == []
+
+    with pytest.raises(ValueError):
+        list(reconcile.iter_json([text[:-20]]))
+
+
+def test_reconcile_should_leave_tracked_task_alone():
+    """A task tracked by the open interval should need no commands"""
+
+    intervals = [{"id": 1, "start": "20190820T200000Z", "tags": ["Foo", "abc"]}]
+
+    assert reconcile.reconcile([BAR, FOO], intervals) == []
+
+
+def test_reconcile_should_start_untracked_task():
+    """An active task without an interval should be started when it was started"""
+
+    intervals = [{"id": 1, "start": "20190820T190000Z", "end": "20190820T193000Z", "tags": ["Bar", "work"]}]
+
+    assert reconcile.reconcile([FOO, BAR], intervals) == [
+        ['timew', 'start', '20190820T200000Z', 'Foo', 'abc', ':yes']]
+
+
+def test_reconcile_should_continue_stopped_interval():
+    """An active task whose interval was closed should be tracked again once nothing else is"""
+
+    intervals = [{"id": 2, "start": "20190820T200000Z", "end": "20190820T201000Z", "tags": ["Foo", "abc"]},
+                 {"id": 1, "start": "20190820T201000Z", "tags": ["Bar", "work"]}]
+    stopped_bar = dict(BAR, start="20190820T201000Z", end="20190820T202000Z", status="completed")
+
+    assert reconcile.reconcile([FOO, stopped_bar], intervals) == [
+        ['timew', 'stop', '20190820T202000Z', ':yes'],
+        ['timew', 'start', '20190820T202000Z', 'Foo', 'abc', ':yes']]
+    assert reconcile.reconcile([FOO, BAR], intervals[:1]) == [
+        ['timew', 'start', '20190820T201000Z', 'Foo', 'abc', ':yes']]
+
+
+def test_reconcile_should_stop_interval_of_stopped_task():
+    """An open interval of a task which is no longer active should be stopped when the task was"""
+
+    intervals = [{"id": 1, "start": "20190820T200000Z", "tags": ["Foo", "abc"]}]
+    stopped_foo = dict(FOO, modified="20190820T203000Z")
+    del stopped_foo["start"]
+
+    assert reconcile.reconcile([stopped_foo, BAR], intervals) == [['timew', 'stop', '20190820T203000Z', ':yes']]
+
+
+def test_reconcile_should_stop_interval_when_latest_instance_was_stopped():
+    """An open interval should not be stopped at the time an earlier task with the same tags was"""
+
+    intervals = [{"id": 1, "start": "20190820T200000Z", "tags": ["Foo", "abc"]}]
+    stopped_foo = dict(FOO, modified="20190820T203000Z")
+    del stopped_foo["start"]
+    earlier_foo = dict(FOO, uuid="0f3b1d4e-29a4-4f8e-a4a7-2c6f3c2d8b11", end="20190813T190000Z", status="completed")
+    later_foo = dict(earlier_foo, end="20190820T202000Z")
+
+    assert reconcile.reconcile([stopped_foo, earlier_foo], intervals) == [
+        ['timew', 'stop', '20190820T203000Z', ':yes']]
+    assert reconcile.reconcile([later_foo, stopped_foo], intervals) == [
+        ['timew', 'stop', '20190820T203000Z', ':yes']]
+    assert reconcile.reconcile([earlier_foo], intervals) == []
+
+
+def test_reconcile_should_retag_interval_found_by_uuid():
+    """An open interval found with the UUID index should get the task's current tags"""
+
+    intervals = [{"id": 1, "start": "20190820T200000Z", "tags": ["Foo", "old"]}]
+    index = {FOO["uuid"]: "20190820T200000Z"}
+
+    when(on_modify).supports_retag().thenReturn(True)
+
+    assert reconcile.reconcile([FOO], intervals, index) == [['timew', 'retag', '@1', 'Foo', 'abc', ':yes']]
+    assert reconcile.reconcile([FOO], intervals) == [['timew', 'start', '20190820T200000Z', 'Foo', 'abc', ':yes']]
+
+    when(on_modify).supports_retag().thenReturn(False)
+
+    assert reconcile.reconcile([FOO], intervals, index) == [['timew', 'untag', '@1', 'old', ':yes'],
+                                                            ['timew', 'tag', '@1', 'abc', ':yes']]
+
+
+def test_main_should_export_tasks_modified_since_watermark(tmp_path, capsys):
+    """An incremental run should only export tasks which are active or were modified since the last one"""
+
+    on_modify.save_state('reconcile.json', {"watermark": "20190820T190000Z"})
+    when(reconcile).export(['timew', 'export', 'from', '20190820T190000Z']).thenReturn(iter([]))
+    when(reconcile).export(reconcile.task_command("20190820T190000Z")).thenReturn(
+        iter([BAR, dict(FOO, description="Foo Bar")]))
+
+    reconcile.main(['--incremental'])
+
+    assert capsys.readouterr().out == "timew start 20190820T200000Z 'Foo Bar' abc :yes\n"
+    assert reconcile.task_command("20190820T190000Z")[-2] == "( +ACTIVE or modified.after:20190820T190000Z )"
+    assert on_modify.load_state('reconcile.json') == {"watermark": "20190820T190000Z"}
+
+
+def test_main_should_apply_commands_and_save_watermark():
+    """Applied commands should run like the hook's and move the watermark on"""
+
+    when(reconcile).export(...).thenReturn(iter([])).thenReturn(iter([BAR, FOO]))
+    when(on_modify).perform([['timew', 'start', '20190820T200000Z', 'Foo', 'abc', ':yes']])
+
+    reconcile.main(['--apply'])
+
+    verify(on_modify).perform([['timew', 'start', '20190820T200000Z', 'Foo', 'abc', ':yes']])
+
+    assert on_modify.load_state('reconcile.json') == {"watermark": "20190820T200000Z"}